@@ -1,196 +1,34 @@
 import streamlit as st
 import google.generativeai as genai
-import json
+import hashlib
+import copy
+import threading
+import uuid
+import time
 import os
-import re
-from datetime import datetime, timedelta, timezone
-from google.oauth2.service_account import Credentials
-import gspread
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# ✅ 変更：画面以外の処理は quiz_core.py へ（コマンドラインの一括生成からも使うため）
+from quiz_core import (
+    JST, CONFLICT,
+    get_user_history, get_user_stats, invalidate_user_cache, put_user_cache, history_cache_report, estimate_size, process_rss_bytes,
+    save_history_to_gs, append_history_rows_to_gs, update_title_in_gs, clear_history_from_gs,
+    archive_one_history_in_gs, restore_one_history_in_gs, delete_one_history_in_gs, bulk_update_quiz_data_in_gs,
+    attach_answer_norm, match_answer,
+    record_grades, save_question_stats, clear_question_stats, due_review_questions,
+    new_dup_index, find_near_duplicate, build_quiz_dup_index, build_history_dup_index, dedup_new_quiz, dedup_history,
+    pdf_parts, prepare_content_parts, generate_summary, start_quiz_generation,
+)
 
 # --- 画面設定 ---
 st.set_page_config(page_title="PDF要約＆クイズ生成ツール", page_icon="🎓", layout="wide")
-JST = timezone(timedelta(hours=+9), 'JST')
-
-# --- Googleスプレッドシート連携 ---
-def get_gspread_client():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    credentials = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scopes)
-    return gspread.authorize(credentials)
-
-# ✅ 追加：archived列を保証（無ければヘッダーに追加）
-def ensure_archived_column(sheet):
-    try:
-        headers = sheet.row_values(1)
-        if "archived" not in headers:
-            sheet.update_cell(1, len(headers) + 1, "archived")
-    except:
-        pass
-
-def load_history_from_gs(user_id):
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)  # ✅ 追加
-        records = sheet.get_all_records()
-
-        user_history = []
-        for r in records:
-            if str(r.get("user_id")) == str(user_id):
-                # ✅ 追加：アーカイブはロードはする（表示側でフィルタもできるが一応残す）
-                q_data = r.get("quiz_data", "[]")
-                if isinstance(q_data, str):
-                    try:
-                        q_data = json.loads(q_data)
-                    except:
-                        q_data = []
-                user_history.append({
-                    "date": r.get("date"),
-                    "title": r.get("title", "無題"),
-                    "score": r.get("score"),
-                    "correct": r.get("correct"),
-                    "total": r.get("total"),
-                    "quiz_data": q_data,
-                    "summary_data": r.get("summary_data"),
-                    "archived": r.get("archived", False)  # ✅ 追加
-                })
-        return user_history
-    except:
-        return []
-
-def save_history_to_gs(user_id, log_entry):
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)  # ✅ 追加
-
-        row = [
-            user_id, log_entry["date"], log_entry.get("title", "無題"),
-            log_entry.get("score", ""), log_entry.get("correct", ""), log_entry.get("total", ""),
-            json.dumps(log_entry.get("quiz_data", []), ensure_ascii=False),
-            log_entry.get("summary_data", "")
-        ]
-
-        # ✅ 追加：archived列分を末尾に付与（新規は未アーカイブ）
-        row.append("")   # ← False じゃなく空欄にする
-
-        sheet.append_row(row)
-    except Exception as e:
-        st.error(f"保存エラー: {e}")
-
-def update_title_in_gs(user_id, date_str, new_title):
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)  # ✅ 追加
-        records = sheet.get_all_records()
-        for idx, r in enumerate(records):
-            if str(r.get("user_id")) == str(user_id) and str(r.get("date")) == str(date_str):
-                sheet.update_cell(idx + 2, 3, new_title)
-                return True
-        return False
-    except:
-        return False
-
-def clear_history_from_gs(user_id):
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)  # ✅ 追加
-
-        cells = sheet.findall(str(user_id))
-        rows_to_delete = sorted(list(set([cell.row for cell in cells])), reverse=True)
-        for row_idx in rows_to_delete:
-            if str(sheet.cell(row_idx, 1).value) == str(user_id):
-                sheet.delete_rows(row_idx)
-        return True
-    except:
-        return False
-
-# ✅ 変更：削除ではなく「アーカイブ」(行は残す)
-def archive_one_history_in_gs(user_id, date_str):
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)
-
-        headers = sheet.row_values(1)
-        archived_col = headers.index("archived") + 1
-
-        records = sheet.get_all_records()
-        for idx, r in enumerate(records):
-            if str(r.get("user_id")) == str(user_id) and str(r.get("date")) == str(date_str):
-                sheet.update_cell(idx + 2, archived_col, True)
-                return True
-        return False
-    except:
-        return False
-
-# 👇 ここを追加（入れ替えじゃない）
-def restore_one_history_in_gs(user_id, date_str):
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)
-
-        headers = sheet.row_values(1)
-        archived_col = headers.index("archived") + 1
-
-        records = sheet.get_all_records()
-        for idx, r in enumerate(records):
-            if str(r.get("user_id")) == str(user_id) and str(r.get("date")) == str(date_str):
-                sheet.update_cell(idx + 2, archived_col, "")
-                return True
-        return False
-    except:
-        return False
-
-# ✅ 追加：生成時点で「作成」、以後は同じ行を「上書き」する（採点もここで上書き）
-def upsert_history_in_gs(user_id, date_str, log_entry):
-    """
-    user_id + date で行を特定し、
-    - 存在すれば：タイトル/スコア/正解数/総数/quiz_data/summary_data を上書き
-    - 無ければ：append で新規作成
-    """
-    try:
-        client = get_gspread_client()
-        sheet = client.open("study_history_db").sheet1
-        ensure_archived_column(sheet)
-
-        records = sheet.get_all_records()
-        target_row = None
-        for idx, r in enumerate(records):
-            if str(r.get("user_id")) == str(user_id) and str(r.get("date")) == str(date_str):
-                target_row = idx + 2  # header+1
-                break
-
-        title = log_entry.get("title", "無題")
-        score = log_entry.get("score", "")
-        correct = log_entry.get("correct", "")
-        total = log_entry.get("total", "")
-        quiz_data = json.dumps(log_entry.get("quiz_data", []), ensure_ascii=False)
-        summary_data = log_entry.get("summary_data", "")
-
-        if target_row:
-            # columns: 1 user_id, 2 date, 3 title, 4 score, 5 correct, 6 total, 7 quiz_data, 8 summary_data
-            sheet.update_cell(target_row, 3, title)
-            sheet.update_cell(target_row, 4, score)
-            sheet.update_cell(target_row, 5, correct)
-            sheet.update_cell(target_row, 6, total)
-            sheet.update_cell(target_row, 7, quiz_data)
-            sheet.update_cell(target_row, 8, summary_data)
-            return True
-        else:
-            # 無ければ新規作成（archivedは空欄）
-            row = [user_id, date_str, title, score, correct, total, quiz_data, summary_data, ""]
-            sheet.append_row(row)
-            return True
-    except:
-        return False
 
 # --- セッション初期化 ---
-for key in ['user_id', 'quiz_history', 'current_quiz', 'results', 'summary', 'current_date', 'edit_mode']:
+# ✅ 変更：履歴・成績インデックスはプロセス共有キャッシュに置き、セッションには user_id と表示中のクイズだけ持つ
+for key in ['user_id', 'current_quiz', 'results', 'summary', 'current_date', 'edit_mode']:
     if key not in st.session_state:
-        st.session_state[key] = None if key != 'quiz_history' and key != 'results' else ([] if key == 'quiz_history' else {})
+        st.session_state[key] = None if key != 'results' else {}
         if key == 'edit_mode':
             st.session_state[key] = False
 
@@ -200,15 +38,38 @@ if 'current_title' not in st.session_state:
 # 追加：モデル名キャッシュ、採点後フラグ（表示安定用）
 if 'model_name' not in st.session_state:
     st.session_state['model_name'] = None
-if 'last_wrong_questions' not in st.session_state:
-    st.session_state['last_wrong_questions'] = []
+if 'last_wrong_idx' not in st.session_state:
+    st.session_state['last_wrong_idx'] = []  # current_quiz の添字だけ持つ（問題のコピーは持たない）
 if 'show_retry' not in st.session_state:
     st.session_state['show_retry'] = False
 
+# ✅ 追加：表示中のクイズの履歴行（id）と、読み込み時の updated_at（同時更新の検出用）
+if 'current_row_id' not in st.session_state:
+    st.session_state['current_row_id'] = None
+if 'current_updated_at' not in st.session_state:
+    st.session_state['current_updated_at'] = None
+
 # ✅ 追加：履歴個別アーカイブの誤爆防止用（対象保持）
 if 'pending_delete' not in st.session_state:
     st.session_state['pending_delete'] = None
 
+# ✅ 追加：このセッションで待っている生成ジョブ（job_id -> 依頼時の user_id）とエラー表示
+if 'jobs' not in st.session_state:
+    st.session_state['jobs'] = {}
+if 'job_error' not in st.session_state:
+    st.session_state['job_error'] = None
+if 'generation_report' not in st.session_state:
+    st.session_state['generation_report'] = None
+
+# ✅ 追加：重複整理の結果メッセージ（rerun後に1回だけ表示）
+if 'dedup_message' not in st.session_state:
+    st.session_state['dedup_message'] = None
+# ✅ 追加：重複整理の確認待ち（削除予定の件数だけ持つ）と、複製直後の注意
+if 'pending_dedup' not in st.session_state:
+    st.session_state['pending_dedup'] = None
+if 'dup_warning' not in st.session_state:
+    st.session_state['dup_warning'] = None
+
 # --- 🎨 CSS: デザイン設定 (修正版) ---
 st.markdown("""
     <style>
@@ -276,6 +137,15 @@ else:
     st.stop()
 
 # --- サイドバー ---
+# ✅ 変更：履歴はこのrun内だけ参照する（セッションには保存しない）
+# 読み込みに失敗したら（429 等）空の履歴として扱うが、キャッシュはしないので次の操作で読み直す
+quiz_history, history_error = [], None
+if st.session_state['user_id']:
+    try:
+        quiz_history = get_user_history(st.session_state['user_id'])
+    except Exception as e:
+        history_error = f"履歴を読み込めませんでした。しばらくしてから再読み込みしてください。（{e}）"
+
 with st.sidebar:
     st.header("👤 ログイン")
     user_input = st.text_input("ユーザー名", value=st.session_state['user_id'] or "")
@@ -283,8 +153,13 @@ with st.sidebar:
         if user_input:
             st.session_state['user_id'] = user_input
             with st.spinner("同期中..."):
-                st.session_state['quiz_history'] = load_history_from_gs(user_input)
+                invalidate_user_cache(user_input)  # ログイン時は最新を読み直す
+                try:
+                    get_user_stats(user_input)
+                except:
+                    pass  # 復習ボタンの表示時にもう一度読む
             st.session_state['pending_delete'] = None
+            st.session_state['pending_dedup'] = None
             st.rerun()
 
     st.divider()
@@ -294,21 +169,52 @@ with st.sidebar:
 
     st.divider()
 
+    # ✅ 追加：今日の復習（全履歴から期限の来た問題だけでクイズを作る）
+    if st.session_state['user_id']:
+        today = datetime.now(JST).strftime("%Y/%m/%d")
+        try:
+            review_quiz = due_review_questions(get_user_stats(st.session_state['user_id']), today)
+        except:
+            review_quiz = []
+        if review_quiz:
+            if st.button(f"📅 今日の復習（{len(review_quiz)}問）", key="review_btn", use_container_width=True, type="primary"):
+                st.session_state.update({
+                    "current_quiz": review_quiz,
+                    "current_title": f"今日の復習 {today}",
+                    "current_date": None,
+                    "current_row_id": None,
+                    "current_updated_at": None,
+                    "summary": None,
+                    "results": {},
+                    "edit_mode": False
+                })
+                st.session_state['show_retry'] = False
+                st.session_state['last_wrong_idx'] = []
+                st.session_state['pending_delete'] = None
+                st.rerun()
+        else:
+            st.caption("📅 今日の復習：期限の来た問題はありません")
+
+        st.divider()
+
     # ✅ 入れ替え：後に履歴
-    if st.session_state['user_id'] and st.session_state['quiz_history']:
+    if history_error:
+        st.warning(history_error)
+    if st.session_state['user_id'] and quiz_history:
         st.header("📊 履歴")
 
         show_archived = st.checkbox("アーカイブ表示", value=False)
 
         if show_archived:
-            visible_history = st.session_state['quiz_history']
+            visible_history = quiz_history
         else:
             visible_history = [
-                h for h in st.session_state['quiz_history']
+                h for h in quiz_history
                 if not h.get("archived", False)
             ]
 
         for i, log in enumerate(reversed(visible_history)):
+            row_id = log.get('id')
             d = log.get('date', '')
             t = log.get('title', '無題')
             s = log.get('score', 0)
@@ -321,26 +227,28 @@ with st.sidebar:
             # 履歴読み込み
             with c_hist:
                 if st.button(btn_label, key=f"hist_{i}", use_container_width=True, type="secondary"):
-                    st.session_state['current_quiz'] = log['quiz_data']
+                    st.session_state['current_quiz'] = copy.deepcopy(log['quiz_data'])  # 共有キャッシュを書き換えないようにコピー
                     st.session_state['summary'] = log['summary_data']
                     st.session_state['current_title'] = t
                     st.session_state['current_date'] = d
+                    st.session_state['current_row_id'] = row_id
+                    st.session_state['current_updated_at'] = log.get('updated_at')
                     st.session_state['edit_mode'] = False
                     st.session_state['results'] = {}
                     st.session_state['show_retry'] = False
-                    st.session_state['last_wrong_questions'] = []
+                    st.session_state['last_wrong_idx'] = []
                     st.session_state['pending_delete'] = None
                     st.rerun()
 
             # 操作ボタン
             with c_del:
                 if st.button("📂", key=f"del_hist_{i}", use_container_width=True):
-                    st.session_state['pending_delete'] = {"date": d, "title": t}
+                    st.session_state['pending_delete'] = {"id": row_id, "date": d, "title": t}
                     st.rerun()
 
             # 確認UI
             pending = st.session_state.get('pending_delete')
-            if pending and pending.get("date") == d:
+            if pending and pending.get("id") == row_id:
                 st.warning(f"この履歴をどうしますか？\n\n📅 {d}\n📝 {t}")
 
                 c_arch, c_delete, c_cancel = st.columns(3)
@@ -349,19 +257,21 @@ with st.sidebar:
                 with c_arch:
                     if not archived_flag:
                         if st.button("アーカイブ", key=f"archive_{i}", use_container_width=True):
-                            ok = archive_one_history_in_gs(st.session_state['user_id'], d)
+                            ok = archive_one_history_in_gs(st.session_state['user_id'], row_id, log.get('updated_at'))
                             st.session_state['pending_delete'] = None
-                            if ok:
-                                st.session_state['quiz_history'] = load_history_from_gs(st.session_state['user_id'])
+                            if ok == CONFLICT:
+                                st.warning("他のタブで更新されていました。最新の履歴を読み直してからやり直してください。")
+                            elif ok:
                                 st.rerun()
                             else:
                                 st.error("アーカイブに失敗しました。")
                     else:
                         if st.button("復活", key=f"restore_{i}", use_container_width=True):
-                            ok = restore_one_history_in_gs(st.session_state['user_id'], d)
+                            ok = restore_one_history_in_gs(st.session_state['user_id'], row_id, log.get('updated_at'))
                             st.session_state['pending_delete'] = None
-                            if ok:
-                                st.session_state['quiz_history'] = load_history_from_gs(st.session_state['user_id'])
+                            if ok == CONFLICT:
+                                st.warning("他のタブで更新されていました。最新の履歴を読み直してからやり直してください。")
+                            elif ok:
                                 st.rerun()
                             else:
                                 st.error("復活に失敗しました。")
@@ -369,18 +279,14 @@ with st.sidebar:
                 # 完全削除
                 with c_delete:
                     if st.button("完全削除", key=f"delete_{i}", use_container_width=True):
-                        client = get_gspread_client()
-                        sheet = client.open("study_history_db").sheet1
-                        records = sheet.get_all_records()
-
-                        for idx2, r2 in enumerate(records):
-                            if str(r2.get("user_id")) == str(st.session_state['user_id']) and str(r2.get("date")) == str(d):
-                                sheet.delete_rows(idx2 + 2)
-                                break
-
+                        ok = delete_one_history_in_gs(st.session_state['user_id'], row_id, log.get('updated_at'))
                         st.session_state['pending_delete'] = None
-                        st.session_state['quiz_history'] = load_history_from_gs(st.session_state['user_id'])
-                        st.rerun()
+                        if ok == CONFLICT:
+                            st.warning("他のタブで更新されていました。最新の履歴を読み直してからやり直してください。")
+                        elif ok:
+                            st.rerun()
+                        else:
+                            st.error("削除に失敗しました。")
 
                 # キャンセル
                 with c_cancel:
@@ -390,31 +296,60 @@ with st.sidebar:
 
         st.markdown("---")
 
+        # ✅ 追加：履歴全体の重複問題を整理（アーカイブ済みの履歴は対象外。削除前に確認する）
+        if st.button("🧹 重複問題を整理", use_container_width=True):
+            with st.spinner("重複を検索中..."):
+                changed, removed = dedup_history(quiz_history)
+            if removed:
+                st.session_state['pending_dedup'] = {"removed": removed, "rows": len(changed)}
+            else:
+                st.session_state['pending_dedup'] = None
+                st.info("重複している問題はありませんでした。")
+
+        pending_dedup = st.session_state.get('pending_dedup')
+        if pending_dedup:
+            st.warning(
+                f"{pending_dedup['rows']}件の履歴から{pending_dedup['removed']}問の重複を削除します。"
+                "元に戻せません（アーカイブ済みの履歴は変更しません）。"
+            )
+            c_run, c_cancel_dedup = st.columns(2)
+            with c_run:
+                if st.button("削除する", key="dedup_confirm", use_container_width=True):
+                    with st.spinner("重複を削除中..."):
+                        # 確認中に履歴が変わっていてもよいように、最新の履歴で数え直してから書き込む
+                        changed, removed = dedup_history(quiz_history)
+                        skipped = bulk_update_quiz_data_in_gs(st.session_state['user_id'], changed)
+                    st.session_state['pending_dedup'] = None
+                    if skipped is not None:
+                        st.session_state['dedup_message'] = f"🧹 {removed}問の重複を削除しました（{len(changed) - skipped}件の履歴を更新）"
+                        if skipped:
+                            st.session_state['dedup_message'] += f"\n\n他のタブで更新中の{skipped}件は飛ばしました。もう一度実行してください。"
+                        st.rerun()
+                    else:
+                        st.error("重複の整理に失敗しました。")
+            with c_cancel_dedup:
+                if st.button("キャンセル", key="dedup_cancel", use_container_width=True):
+                    st.session_state['pending_dedup'] = None
+                    st.rerun()
+
         if st.button("🗑️ 履歴を全削除", use_container_width=True):
             if clear_history_from_gs(st.session_state['user_id']):
-                st.session_state['quiz_history'] = []
+                clear_question_stats(st.session_state['user_id'])
                 st.session_state['pending_delete'] = None
                 st.rerun()
 
-# --- ここから追加の“壊れにくくする”関数（UI/構造は触らない） ---
-def parse_json_safely(res_text: str):
-    """LLM出力からJSONをできるだけ安全に抽出"""
-    t = (res_text or "").strip()
-    # コードブロック除去
-    t = t.replace("```json", "```").replace("```", "")
-    start = t.find("{")
-    end = t.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        raise ValueError("JSONが見つかりません")
-    return json.loads(t[start:end+1])
-
-def norm_answer(s: str) -> str:
-    """採点用：表記ゆれを軽減（空白/記号/全角空白など）"""
-    s = str(s).strip().lower()
-    s = s.replace("　", "")
-    s = re.sub(r"\s+", "", s)
-    s = s.replace("・", "").replace("、", "").replace("。", "")
-    return s
+    # ✅ 追加：メモリ使用量（このセッション / プロセス全体）
+    with st.expander("🧠 メモリ使用量", expanded=False):
+        session_bytes = estimate_size({k: v for k, v in st.session_state.items()})
+        report = history_cache_report()
+        rss = process_rss_bytes()
+        st.caption(f"このセッション: {session_bytes / 1024:.1f} KB")
+        st.caption(
+            f"共有履歴キャッシュ: {report['bytes'] / 1024:.1f} KB"
+            f"（{report['users']}ユーザー / ヒット {report['hits']} ・ ミス {report['misses']}）"
+        )
+        if rss:
+            st.caption(f"プロセス全体（最大RSS）: {rss / 1024 / 1024:.1f} MB")
 
 # ✅ 追加：問題削除/追加後に入力ウィジェットをリセット
 def reset_quiz_input_widgets():
@@ -423,39 +358,241 @@ def reset_quiz_input_widgets():
             st.session_state.pop(k, None)
     st.session_state['results'] = {}
 
-# --- AI処理 ---
-def get_available_model():
-    return genai.GenerativeModel("gemini-2.5-pro")
-
-def generate_summary(files):
-    model = get_available_model()
-    if not model:
-        return None
-    content = ["資料の要点を、分かりやすく要約してください。"]
-    for f in files:
-        content.append({"mime_type": "application/pdf", "data": f.getvalue()})
+# ✅ 追加：生成ジョブのキュー（プロセス共有・ワーカー数上限あり）
+# 画面のrerunで生成が止まらないよう別スレッドで実行し、同じ内容の実行中ジョブは1つにまとめる。
+# クイズは完了時にワーカー側で履歴へ保存するので、待っている間に別の画面へ移動してもよい
+GENERATION_WORKERS = 4
+JOB_TTL_SEC = 30 * 60  # 完了したジョブを残しておく時間（受け取り前に消えないように）
+
+@st.cache_resource
+def get_job_queue():
+    return {
+        "executor": ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generation"),
+        "lock": threading.Lock(),
+        "jobs": {},      # job_id -> job
+        "inflight": {},  # 内容ハッシュ -> 実行中の job_id
+        "latency": {},   # 送信方法（text/mixed/pdf） -> [合計秒, ページ数]
+    }
+
+def job_content_hash(kind: str, parts) -> str:
+    h = hashlib.sha256(kind.encode("utf-8"))
+    for part in parts:
+        h.update(hashlib.sha256(part["data"]).digest())
+    return h.hexdigest()
+
+def _cleanup_jobs(queue):
+    now = time.time()
+    for job_id, job in list(queue["jobs"].items()):
+        if job["finished_at"] and now - job["finished_at"] > JOB_TTL_SEC:
+            queue["jobs"].pop(job_id, None)
+
+def submit_generation_job(kind: str, parts, user_id=None, summary_data=""):
+    """
+    kind は "summary" / "quiz"。同じ内容のジョブが実行中ならそれに相乗りして同じ job_id を返す。
+    user_id を渡したクイズジョブは、完了時にそのユーザーの履歴へ保存される
+    """
+    queue = get_job_queue()
+    content_hash = job_content_hash(kind, parts)
+    with queue["lock"]:
+        _cleanup_jobs(queue)
+        job_id = queue["inflight"].get(content_hash)
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+            queue["jobs"][job_id] = {
+                "id": job_id,
+                "kind": kind,
+                "hash": content_hash,
+                "parts": list(parts),
+                "status": "queued",  # queued -> running -> saving -> done / error
+                "progress": 0.0,
+                "message": "順番待ち...",
+                "subscribers": {},   # user_id -> 保存する summary_data
+                "deliveries": {},    # user_id -> 保存結果
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "finished_at": None,
+            }
+            queue["inflight"][content_hash] = job_id
+            queue["executor"].submit(_run_generation_job, job_id)
+        if user_id:
+            queue["jobs"][job_id]["subscribers"].setdefault(str(user_id), summary_data or "")
+    return job_id
+
+def get_job(job_id):
+    queue = get_job_queue()
+    with queue["lock"]:
+        return queue["jobs"].get(job_id)
+
+def _update_job(job_id, **fields):
+    queue = get_job_queue()
+    with queue["lock"]:
+        queue["jobs"][job_id].update(fields)
+
+def save_generated_quiz(user_id, title, quiz, summary_data=""):
+    """
+    生成したクイズをユーザーの履歴に新規保存（重複チェック込み）。セッションに渡す内容を返す。
+    ワーカースレッドで呼ぶので st.error は使わず、保存に失敗したら "error" に理由を入れて返す
+    """
     try:
-        with st.spinner("要約中..."):
-            return model.generate_content(content).text
+        history_index = build_history_dup_index(get_user_history(user_id))
     except:
-        return None
-
-def start_quiz_generation(files):
-    model = get_available_model()
-    if not model:
-        return "無題", []
-    prompt = """PDFからクイズ15問をJSONで出力。
-【重要】記述式や穴埋め問題の場合、optionsは必ず空リスト[]にすること。
-【重要】出力はJSONのみ。前後に説明文やコードブロックは付けないこと。
-{"title": "タイトル", "quizzes": [{"question": "..", "options": ["..", ".."], "answer": "..", "explanation": ".."}]}"""
-    content = [prompt] + [{"mime_type": "application/pdf", "data": f.getvalue()} for f in files]
+        history_index = new_dup_index()  # 履歴が読めないときは過去との重複チェックだけ飛ばす
+    quiz, dropped = dedup_new_quiz(copy.deepcopy(quiz), history_index)
+    date_str = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
+    row_id, stamp, error = None, None, None
     try:
-        with st.spinner("クイズ作成中..."):
-            res = model.generate_content(content).text
-            data = parse_json_safely(res)
-            return data.get("title", "無題"), data.get("quizzes", [])
-    except:
-        return "無題", []
+        [(row_id, stamp)] = append_history_rows_to_gs([(user_id, {
+            "date": date_str,
+            "title": title,
+            "score": "",
+            "correct": "",
+            "total": "",
+            "quiz_data": quiz,
+            "summary_data": summary_data or ""
+        })])
+    except Exception as e:
+        error = f"履歴への保存に失敗しました：{e}"
+    return {
+        "title": title, "quiz": quiz, "dropped": dropped, "date": date_str,
+        "row_id": row_id, "updated_at": stamp, "error": error,
+    }
+
+def _run_generation_job(job_id):
+    queue = get_job_queue()
+    job = get_job(job_id)
+    _update_job(job_id, status="running", progress=0.1, message="PDFを解析中...")
+    try:
+        parts, report = prepare_content_parts(job["parts"])
+        _update_job(job_id, progress=0.3, message="生成中...")
+        usage = {}
+        if job["kind"] == "summary":
+            result = generate_summary(parts, usage)
+            if not result:
+                raise ValueError("要約を作成できませんでした")
+        else:
+            title, quiz = start_quiz_generation(parts, usage)
+            quiz = [attach_answer_norm(x) for x in quiz if isinstance(x, dict)]
+            if not quiz:
+                raise ValueError("クイズを作成できませんでした")
+            result = {"title": title, "quiz": quiz}
+        report.update(usage)
+        report["mode"] = (
+            "pdf" if not report["text_pages"]
+            else "text" if report["text_pages"] == report["pages"] else "mixed"
+        )
+        with queue["lock"]:
+            total = queue["latency"].setdefault(report["mode"], [0.0, 0])
+            total[0] += report.get("seconds") or 0.0
+            total[1] += report["pages"] or 1
+    except Exception as e:
+        with queue["lock"]:
+            queue["inflight"].pop(job["hash"], None)
+            job.update(status="error", error=str(e), message="失敗", parts=None, finished_at=time.time())
+        return
+
+    # ここから先に来た相乗りは新しいジョブになるので、保存先はこの時点で確定
+    with queue["lock"]:
+        queue["inflight"].pop(job["hash"], None)
+        subscribers = dict(job["subscribers"])
+        job.update(status="saving", progress=0.8, message="履歴に保存中...", result=result, report=report, parts=None)
+
+    if job["kind"] == "quiz":
+        for user_id, summary_data in subscribers.items():
+            try:
+                delivery = save_generated_quiz(user_id, result["title"], result["quiz"], summary_data)
+            except Exception as e:
+                delivery = {"error": f"履歴への保存に失敗しました：{e}"}
+            with queue["lock"]:
+                job["deliveries"][user_id] = delivery
+
+    _update_job(job_id, status="done", progress=1.0, message="完了", finished_at=time.time())
+
+def format_generation_report(report):
+    """PDFテキスト抽出でどれだけ節約できたかの表示用文字列"""
+    if not report:
+        return ""
+    msg = f"📄 {report['text_pages']}/{report['pages']}ページをテキストで送信"
+    if report["saved_tokens"]:
+        msg += f"（推定 約{report['saved_tokens']:,}トークン削減）"
+    if report.get("prompt_tokens"):
+        msg += f" ・ 入力 {report['prompt_tokens']:,}トークン"
+    if report.get("seconds"):
+        msg += f" ・ 生成 {report['seconds']:.1f}秒"
+        # 別の資料のジョブとの比較なので「短縮」とは言わず、1ページあたりの平均を参考として出すだけ
+        queue = get_job_queue()
+        with queue["lock"]:
+            pdf_total = list(queue["latency"].get("pdf", [0.0, 0]))
+        if report["mode"] != "pdf" and pdf_total[1] and report["pages"]:
+            msg += (
+                f"（{report['seconds'] / report['pages']:.2f}秒/ページ。"
+                f"参考：PDFのまま送ったジョブの平均 {pdf_total[0] / pdf_total[1]:.2f}秒/ページ）"
+            )
+    return msg
+
+def deliver_job_result(job, user_id):
+    """完了したジョブの結果をこのセッションに反映"""
+    st.session_state['generation_report'] = format_generation_report(job.get("report"))
+    if job["kind"] == "summary":
+        st.session_state['summary'] = job["result"]
+        return
+
+    delivery = job["deliveries"].get(str(user_id)) if user_id else None
+    if delivery and delivery.get("error"):
+        st.session_state['job_error'] = (
+            f"{delivery['error']}（クイズは表示しますが、まだ履歴にはありません。採点すると新しい履歴として保存されます）"
+        )
+        if "quiz" not in delivery:
+            delivery = None
+    if delivery is None:
+        # 未ログイン（または保存前に失敗）：履歴なしでクイズ内の重複だけ除く
+        quiz, dropped = dedup_new_quiz(copy.deepcopy(job["result"]["quiz"]), new_dup_index())
+        delivery = {
+            "title": job["result"]["title"], "quiz": quiz, "dropped": dropped,
+            "date": datetime.now(JST).strftime("%Y/%m/%d %H:%M"), "row_id": None, "updated_at": None
+        }
+
+    reset_quiz_input_widgets()
+    st.session_state.update({
+        "current_title": delivery["title"],
+        "current_quiz": copy.deepcopy(delivery["quiz"]),
+        "current_date": delivery["date"],
+        "current_row_id": delivery["row_id"],
+        "current_updated_at": delivery["updated_at"],
+        "results": {},
+        "edit_mode": False
+    })
+    st.session_state['show_retry'] = False
+    st.session_state['last_wrong_idx'] = []
+    if delivery["dropped"]:
+        st.session_state['dedup_message'] = f"🧹 生成されたクイズから{delivery['dropped']}問の重複を削除しました"
+
+# ✅ 追加：このセッションのジョブの進み具合（2秒ごとに確認し、終わったら画面全体を更新）
+@st.fragment(run_every=2)
+def show_job_progress():
+    jobs = st.session_state.get('jobs') or {}
+    if not jobs:
+        return
+    finished = False
+    for job_id, user_id in list(jobs.items()):
+        job = get_job(job_id)
+        if job is None:
+            jobs.pop(job_id, None)
+            continue
+        label = "📝 要約" if job["kind"] == "summary" else "🚀 クイズ"
+        if job["status"] == "done":
+            deliver_job_result(job, user_id)
+            jobs.pop(job_id, None)
+            finished = True
+        elif job["status"] == "error":
+            st.session_state['job_error'] = f"{label}の作成に失敗しました：{job['error']}"
+            jobs.pop(job_id, None)
+            finished = True
+        else:
+            elapsed = int(time.time() - job["created_at"])
+            st.progress(job["progress"], text=f"{label}：{job['message']}（{elapsed}秒）")
+    if finished:
+        st.rerun()
 
 # --- メインロジック ---
 if uploaded_files:
@@ -464,49 +601,39 @@ if uploaded_files:
     # ===== 要約 =====
     with c1:
         if st.button("📝 資料を要約する", use_container_width=True):
-            st.session_state['summary'] = generate_summary(uploaded_files)
+            job_id = submit_generation_job("summary", pdf_parts(uploaded_files))
+            st.session_state['jobs'][job_id] = st.session_state.get('user_id')
+            st.rerun()
 
     # ===== クイズ生成 =====
     with c2:
         if st.button("🚀 クイズを生成", use_container_width=True, type="primary"):
+            # 🔥 毎回必ず新しい履歴として作る（上書き防止）。保存は完了時にワーカー側で行う
+            job_id = submit_generation_job(
+                "quiz", pdf_parts(uploaded_files),
+                user_id=st.session_state.get('user_id'),
+                summary_data=st.session_state.get('summary') or ""
+            )
+            st.session_state['jobs'][job_id] = st.session_state.get('user_id')
+            st.rerun()
 
-            t, q = start_quiz_generation(uploaded_files)
+show_job_progress()
 
-            # 🔥 毎回必ず新しい履歴として作る（上書き防止）
-            st.session_state['current_date'] = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
+if st.session_state.get('job_error'):
+    st.error(st.session_state['job_error'])
+    st.session_state['job_error'] = None
 
-            st.session_state.update({
-                "current_title": t,
-                "current_quiz": q,
-                "results": {},
-                "edit_mode": False
-            })
+if st.session_state.get('generation_report'):
+    st.caption(st.session_state['generation_report'])
 
-            st.session_state['show_retry'] = False
-            st.session_state['last_wrong_questions'] = []
-
-            # ===== 履歴に新規追加 =====
-            if st.session_state.get('user_id'):
-                init_log = {
-                    "date": st.session_state['current_date'],
-                    "title": t,
-                    "score": "",
-                    "correct": "",
-                    "total": "",
-                    "quiz_data": q,
-                    "summary_data": st.session_state.get('summary') or ""
-                }
-
-                save_history_to_gs(
-                    st.session_state['user_id'],
-                    init_log
-                )
+if st.session_state.get('dedup_message'):
+    st.success(st.session_state['dedup_message'])
+    st.session_state['dedup_message'] = None
 
-                st.session_state['quiz_history'] = load_history_from_gs(
-                    st.session_state['user_id']
-                )
+if st.session_state.get('dup_warning'):
+    st.warning(st.session_state['dup_warning'])
+    st.session_state['dup_warning'] = None
 
-            st.rerun()
 if st.session_state['summary']:
     st.info(f"### 📋 要約\n{st.session_state['summary']}")
 
@@ -523,12 +650,21 @@ if st.session_state['current_quiz']:
     with col_btn:
         if st.session_state['edit_mode']:
             if st.button("💾 保存", use_container_width=True):
-                if st.session_state['current_date'] and st.session_state['user_id']:
-                    update_title_in_gs(st.session_state['user_id'], st.session_state['current_date'], new_title_input)
-                    st.session_state['quiz_history'] = load_history_from_gs(st.session_state['user_id'])
-                st.session_state['current_title'] = new_title_input
-                st.session_state['edit_mode'] = False
-                st.rerun()
+                res = None
+                if st.session_state['current_row_id'] and st.session_state['user_id']:
+                    res = update_title_in_gs(
+                        st.session_state['user_id'], st.session_state['current_row_id'],
+                        new_title_input, st.session_state['current_updated_at']
+                    )
+                if res == CONFLICT:
+                    # 他のタブで更新済み → 上書きしない（行は id で特定しているので別の行に書くことはない）
+                    st.warning("他のタブでこのクイズが更新されていました。履歴から開き直してから題名を変更してください。")
+                else:
+                    if res:
+                        st.session_state['current_updated_at'] = res
+                    st.session_state['current_title'] = new_title_input
+                    st.session_state['edit_mode'] = False
+                    st.rerun()
         else:
             if st.button("✏️ 題名を変更", use_container_width=True):
                 st.session_state['edit_mode'] = True
@@ -562,7 +698,7 @@ if st.session_state['current_quiz']:
 
             reset_quiz_input_widgets()
             st.session_state['show_retry'] = False
-            st.session_state['last_wrong_questions'] = []
+            st.session_state['last_wrong_idx'] = []
             st.rerun()
 
         st.markdown("---")
@@ -639,12 +775,13 @@ if st.session_state['current_quiz']:
                         qref["options"] = opts_list if opts_list else []
                         qref["answer"] = str(edit_ans).strip()
                         qref["explanation"] = str(edit_exp).strip()
+                        attach_answer_norm(qref)
                         qref.pop("user_ans", None)
                         qref.pop("is_correct", None)
 
                         reset_quiz_input_widgets()
                         st.session_state['show_retry'] = False
-                        st.session_state['last_wrong_questions'] = []
+                        st.session_state['last_wrong_idx'] = []
                         st.rerun()
 
             with c_dup:
@@ -656,11 +793,17 @@ if st.session_state['current_quiz']:
                         "answer": qref.get("answer", ""),
                         "explanation": qref.get("explanation", "")
                     }
+                    attach_answer_norm(copied)
                     st.session_state['current_quiz'].append(copied)
+                    # 複製はそのままだと重複問題なので、編集するよう知らせる
+                    st.session_state['dup_warning'] = (
+                        f"Q{edit_idx + 1} を Q{len(st.session_state['current_quiz'])} に複製しました。"
+                        "同じ内容のままだと重複問題として整理の対象になるので、問題文を編集してください。"
+                    )
 
                     reset_quiz_input_widgets()
                     st.session_state['show_retry'] = False
-                    st.session_state['last_wrong_questions'] = []
+                    st.session_state['last_wrong_idx'] = []
                     st.rerun()
 
             with c_cancel:
@@ -699,30 +842,36 @@ if st.session_state['current_quiz']:
         new_exp = st.text_area("解説（explanation）", key="add_exp_text", placeholder="解説を書いておくと復習が楽。", height=80)
 
         if st.button("➕ この問題を追加", type="primary", use_container_width=True, key="add_btn"):
+            opts_list = []
+            if mode == "選択式（optionsあり）":
+                raw = (new_opts or "").strip()
+                if raw:
+                    if "\n" in raw:
+                        opts_list = [x.strip() for x in raw.splitlines() if x.strip()]
+                    else:
+                        opts_list = [x.strip() for x in raw.split(",") if x.strip()]
+
+            dup_idx = find_near_duplicate(
+                build_quiz_dup_index(st.session_state['current_quiz']),
+                {"question": new_q, "options": opts_list, "answer": new_ans}
+            )
             if not str(new_q).strip():
                 st.error("問題文が空です。")
             elif not str(new_ans).strip():
                 st.error("正解（answer）が空です。")
+            elif dup_idx is not None:
+                st.error(f"ほぼ同じ問題が Q{dup_idx + 1} にあります。")
             else:
-                opts_list = []
-                if mode == "選択式（optionsあり）":
-                    raw = (new_opts or "").strip()
-                    if raw:
-                        if "\n" in raw:
-                            opts_list = [x.strip() for x in raw.splitlines() if x.strip()]
-                        else:
-                            opts_list = [x.strip() for x in raw.split(",") if x.strip()]
-
-                st.session_state['current_quiz'].append({
+                st.session_state['current_quiz'].append(attach_answer_norm({
                     "question": str(new_q).strip(),
                     "options": opts_list if opts_list else [],
                     "answer": str(new_ans).strip(),
                     "explanation": str(new_exp).strip()
-                })
+                }))
 
                 reset_quiz_input_widgets()
                 st.session_state['show_retry'] = False
-                st.session_state['last_wrong_questions'] = []
+                st.session_state['last_wrong_idx'] = []
                 st.rerun()
 
         # クイズフォーム
@@ -735,6 +884,8 @@ if st.session_state['current_quiz']:
                 <div class="question-text">{question_text}</div>
             </div>
             """, unsafe_allow_html=True)
+            if q.get('dup_of'):
+                st.caption(f"🔁 過去の「{q['dup_of']}」にほぼ同じ問題があります")
 
             opts = q.get('options', [])
             if opts and isinstance(opts, list) and len(opts) >= 2:
@@ -751,12 +902,12 @@ if st.session_state['current_quiz']:
     # ===== フォーム外処理 =====
     if submitted:
         correct = 0
-        wrong_questions = []
+        wrong_idx = []
 
         for i, q in enumerate(st.session_state['current_quiz']):
             ans = st.session_state['results'].get(i, "")
 
-            is_correct = norm_answer(ans) == norm_answer(q.get('answer', ''))
+            is_correct = match_answer(ans, q)
 
             st.session_state['current_quiz'][i]['user_ans'] = ans
             st.session_state['current_quiz'][i]['is_correct'] = is_correct
@@ -766,7 +917,7 @@ if st.session_state['current_quiz']:
                 correct += 1
             else:
                 st.error(f"第{i+1}問: 不正解 (正解: {q.get('answer')})")
-                wrong_questions.append(st.session_state['current_quiz'][i])
+                wrong_idx.append(i)
 
             st.markdown("#### 解説")
             st.write(q.get('explanation', ''))
@@ -808,34 +959,55 @@ if st.session_state['current_quiz']:
                 "summary_data": st.session_state['summary']
             }
 
-            # 以前の日付があればアーカイブ
-            if st.session_state.get('current_date'):
-                archive_one_history_in_gs(
+            # 以前の行があればアーカイブ（他のタブが先に更新していたら触らない）
+            if st.session_state.get('current_row_id'):
+                res = archive_one_history_in_gs(
                     st.session_state['user_id'],
-                    st.session_state['current_date']
+                    st.session_state['current_row_id'],
+                    st.session_state.get('current_updated_at')
                 )
+                if res == CONFLICT:
+                    st.warning("他のタブで元の履歴が更新されていたため、アーカイブせずに新しい履歴として保存しました。")
 
-            # 新しい日付で保存
-            save_history_to_gs(
+            # 新しい行で保存
+            row_id, stamp = save_history_to_gs(
                 st.session_state['user_id'],
                 new_log
             )
 
-            # セッションの日付も更新
+            # セッションの日付・行も更新
             st.session_state['current_date'] = new_date
+            st.session_state['current_row_id'] = row_id
+            st.session_state['current_updated_at'] = stamp
 
-            st.session_state['quiz_history'] = load_history_from_gs(
-                st.session_state['user_id']
-            )
+            # ✅ 追加：問題ごとの成績インデックスを差分更新
+            # （キャッシュ上のオブジェクトは共有なので、コピーを更新して保存できたら差し替える）
+            uid = st.session_state['user_id']
+            try:
+                stats = copy.deepcopy(get_user_stats(uid))
+            except:
+                stats = None
+            if stats is None:
+                st.warning("成績の記録を読み込めなかったため、今回の結果は復習スケジュールに反映されていません。")
+            else:
+                changed = record_grades(stats, st.session_state['current_quiz'], new_date[:10])
+                if save_question_stats(uid, stats, changed):
+                    put_user_cache("stats", uid, stats)
+                else:
+                    invalidate_user_cache(uid, kinds=("stats",))
+                    st.warning("成績の記録を保存できませんでした。今回の結果は復習スケジュールに反映されていません。")
 
         # ===== リトライ準備も if の中 =====
-        st.session_state['last_wrong_questions'] = wrong_questions
+        st.session_state['last_wrong_idx'] = wrong_idx
         st.session_state['show_retry'] = True
 
 
 # 💡【間違えた問題だけリトライ】
-if st.session_state.get('show_retry') and st.session_state.get('last_wrong_questions'):
-    wq = st.session_state['last_wrong_questions']
+if st.session_state.get('show_retry') and st.session_state.get('last_wrong_idx'):
+    wq = [
+        st.session_state['current_quiz'][i] for i in st.session_state['last_wrong_idx']
+        if i < len(st.session_state['current_quiz'] or [])
+    ]
     st.info(f"前回の結果：{len(wq)}問の間違いがありました。")
     if st.button(
         f"🔥 間違えた{len(wq)}問だけでリベンジする",
@@ -848,6 +1020,8 @@ if st.session_state.get('show_retry') and st.session_state.get('last_wrong_quest
         )
         st.session_state['results'] = {}
         st.session_state['current_date'] = None
+        st.session_state['current_row_id'] = None
+        st.session_state['current_updated_at'] = None
         st.session_state['show_retry'] = False
-        st.session_state['last_wrong_questions'] = []
+        st.session_state['last_wrong_idx'] = []
         st.rerun()
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+PDFフォルダからクイズを一括生成して、履歴シートにまとめて保存する（Streamlit画面なし）。
+
+    python batch_generate.py lectures/ --user teacher01 --workers 4 --summary
+
+- 要約・クイズ生成・重複チェック・履歴保存は app.py と同じ処理（quiz_core.py）を使う
+- 設定は app.py と同じ .streamlit/secrets.toml（GEMINI_API_KEY / gcp_service_account）
+- 生成結果はチェックポイントファイルに記録するので、途中で失敗しても同じコマンドで続きから再開できる
+- 履歴へは --flush-every 件ごとに append_rows でまとめて書き込む
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import streamlit as st
+import google.generativeai as genai
+
+from quiz_core import (
+    JST,
+    new_row_id,
+    attach_answer_norm,
+    prepare_content_parts,
+    generate_summary,
+    start_quiz_generation,
+    get_user_history,
+    build_history_dup_index,
+    add_to_dup_index,
+    dedup_new_quiz,
+    append_history_rows_to_gs,
+)
+
+CHECKPOINT_NAME = ".quiz_batch_checkpoint.json"
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_checkpoint(path, user_id):
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("user_id") == user_id:
+            return data
+        print(f"⚠️ チェックポイントのユーザー（{data.get('user_id')}）が違うので、最初から処理します")
+    return {"user_id": user_id, "files": {}}
+
+
+def save_checkpoint(path, data):
+    """書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def generate_for_pdf(path, with_summary, retries):
+    """PDF1つ分：要約（任意）とクイズを生成する。ワーカースレッドで実行"""
+    with open(path, "rb") as f:
+        data = f.read()
+    parts, report = prepare_content_parts([{"mime_type": "application/pdf", "data": data}])
+
+    summary = (generate_summary(parts) or "") if with_summary else ""
+
+    title, quiz = "無題", []
+    for attempt in range(retries + 1):
+        title, quiz = start_quiz_generation(parts)
+        quiz = [attach_answer_norm(q) for q in quiz if isinstance(q, dict)]
+        if quiz:
+            break
+        if attempt < retries:
+            time.sleep(2 ** attempt)
+    if not quiz:
+        raise RuntimeError("クイズを作成できませんでした")
+
+    if not title or title == "無題":
+        title = os.path.splitext(os.path.basename(path))[0]
+    return {"title": title, "quiz": quiz, "summary": summary, "report": report}
+
+
+def flush(user_id, checkpoint, checkpoint_path, pending, history_index):
+    """生成済み（未保存）の分を重複チェックしてから履歴にまとめて追加する。失敗したら False（pending は残す）"""
+    if not pending:
+        return True
+    date_str = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
+
+    # 行の id は保存前にチェックポイントへ記録しておく。
+    # 書き込みは成功したのに応答前に落ちた場合でも、次回は同じ id の行が既にあるので追加されない
+    if any(not checkpoint["files"][sha].get("row_id") for sha in pending):
+        for sha in pending:
+            checkpoint["files"][sha].setdefault("row_id", new_row_id())
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    entries = []
+    for sha in pending:
+        result = checkpoint["files"][sha]["result"]
+        quiz, dropped = dedup_new_quiz(copy.deepcopy(result["quiz"]), history_index)
+        for q in quiz:
+            add_to_dup_index(history_index, q, result["title"])  # 同じバッチ内の重複にも印を付ける
+        if dropped:
+            print(f"  🧹 {result['title']}: クイズ内の重複 {dropped}問を削除")
+        entries.append((user_id, {
+            "id": checkpoint["files"][sha]["row_id"],
+            "date": date_str,
+            "title": result["title"],
+            "score": "",
+            "correct": "",
+            "total": "",
+            "quiz_data": quiz,
+            "summary_data": result["summary"],
+        }))
+
+    try:
+        keys = append_history_rows_to_gs(entries)
+    except Exception as e:
+        print(f"⚠️ 履歴への保存に失敗しました（次回まとめて再試行します）: {e}")
+        # 保存できなかった分もインデックスに入ってしまったので、シートの内容から作り直す
+        try:
+            rebuilt = build_history_dup_index(get_user_history(user_id))
+        except Exception:
+            return False  # 読み直せないときは今のインデックスのまま（重複の印が多めに付くだけ）
+        history_index.clear()
+        history_index.update(rebuilt)
+        return False
+    for sha, (row_id, _) in zip(pending, keys):
+        entry = checkpoint["files"][sha]
+        entry["status"] = "saved"
+        entry["row_id"] = row_id
+        entry.pop("result", None)
+    save_checkpoint(checkpoint_path, checkpoint)
+    print(f"💾 {len(entries)}件を履歴に保存しました")
+    pending.clear()
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDFフォルダからクイズを一括生成して履歴に保存します")
+    parser.add_argument("directory", help="PDFの入ったフォルダ")
+    parser.add_argument("--user", required=True, help="保存先のユーザー名（画面でログインするユーザー名）")
+    parser.add_argument("--workers", type=int, default=4, help="同時に生成する数（既定: 4）")
+    parser.add_argument("--summary", action="store_true", help="要約も作って履歴に保存する")
+    parser.add_argument("--flush-every", type=int, default=10, help="何件ごとに履歴へまとめて書き込むか（既定: 10）")
+    parser.add_argument("--retries", type=int, default=2, help="クイズ生成に失敗したときの再試行回数（既定: 2）")
+    parser.add_argument("--checkpoint", help=f"チェックポイントファイル（既定: <directory>/{CHECKPOINT_NAME}）")
+    args = parser.parse_args(argv)
+
+    if "GEMINI_API_KEY" not in st.secrets:
+        print("APIキーが設定されていません。secrets.tomlにGEMINI_API_KEYを設定してください。", file=sys.stderr)
+        return 2
+    genai.configure(api_key=st.secrets["GEMINI_API_KEY"].strip())
+
+    pdfs = sorted(
+        os.path.join(args.directory, name) for name in os.listdir(args.directory)
+        if name.lower().endswith(".pdf")
+    )
+    checkpoint_path = args.checkpoint or os.path.join(args.directory, CHECKPOINT_NAME)
+    checkpoint = load_checkpoint(checkpoint_path, args.user)
+    files = checkpoint["files"]
+
+    todo = []
+    for path in pdfs:
+        sha = file_sha256(path)
+        status = files.get(sha, {}).get("status")
+        if status == "saved" or any(sha == t[0] for t in todo):
+            continue
+        if status != "generated":
+            todo.append((sha, path))
+        files.setdefault(sha, {})["path"] = path
+
+    # 前回、生成までは済んで保存前に止まった分
+    pending = [sha for sha, entry in files.items() if entry.get("status") == "generated"]
+    done = sum(1 for entry in files.values() if entry.get("status") == "saved")
+    print(f"📚 PDF {len(pdfs)}件（生成 {len(todo)}件 / 保存待ち {len(pending)}件 / 済み {done}件）")
+
+    try:
+        history_index = build_history_dup_index(get_user_history(args.user))
+    except Exception as e:
+        print(f"履歴を読み込めませんでした（重複チェックに必要です）: {e}", file=sys.stderr)
+        return 1
+    flush(args.user, checkpoint, checkpoint_path, pending, history_index)
+
+    failed, text_pages, total_pages, saved_tokens = 0, 0, 0, 0
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(generate_for_pdf, path, args.summary, args.retries): (sha, path)
+            for sha, path in todo
+        }
+        for n, future in enumerate(as_completed(futures), 1):
+            sha, path = futures[future]
+            name = os.path.basename(path)
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                files[sha].update(status="failed", error=str(e))
+                save_checkpoint(checkpoint_path, checkpoint)
+                print(f"[{n}/{len(todo)}] ❌ {name}: {e}")
+                continue
+
+            report = result.pop("report")
+            text_pages += report["text_pages"]
+            total_pages += report["pages"]
+            saved_tokens += report["saved_tokens"]
+
+            files[sha].update(status="generated", result=result, row_id=new_row_id())
+            files[sha].pop("error", None)
+            save_checkpoint(checkpoint_path, checkpoint)
+            pending.append(sha)
+            print(f"[{n}/{len(todo)}] ✅ {name}: {result['title']}（{len(result['quiz'])}問）")
+
+            if len(pending) >= max(1, args.flush_every):
+                flush(args.user, checkpoint, checkpoint_path, pending, history_index)
+
+    saved_all = flush(args.user, checkpoint, checkpoint_path, pending, history_index)
+
+    print(f"⏱️ {time.time() - started:.1f}秒 ・ 失敗 {failed}件")
+    if total_pages:
+        print(f"📄 {text_pages}/{total_pages}ページをテキストで送信（推定 約{saved_tokens:,}トークン削減）")
+    if failed or not saved_all:
+        print("失敗した分は、同じコマンドをもう一度実行すると再試行します。")
+    return 1 if failed or not saved_all else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
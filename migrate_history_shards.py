@@ -0,0 +1,182 @@
+"""
+履歴シート（study_history_db の sheet1）と成績シート（question_stats）をユーザーごとの shard ワークシートに分ける移行ツール。
+
+    python migrate_history_shards.py --shards 16          # コピーして切り替え（一度だけ）
+    python migrate_history_shards.py --resume             # 途中で止まったときの再開
+    python migrate_history_shards.py --drop-legacy        # コピーを確認してから移行元のセルを空ける
+
+- user_id のハッシュで history_NN / question_stats_NN に振り分け、append_rows でまとめて書き込む
+- 最後に対応表（history_directory）を作ると、app.py / batch_generate.py の読み書きが shard に切り替わる
+- 切り替え後、実行中のアプリが対応表を読み直すまで待ってから、その間に移行元へ追加された行だけをコピーする
+  （最初に読んだ時点で無かったキーの行だけ。切り替え後に shard で削除された行は戻さない）
+  その間の移行元での更新・削除は反映されないので、なるべく利用者のいない時間に実行する
+- 進み具合は状態ファイルに記録する。切り替え後にもう一度実行すると、削除した履歴が戻ってしまうので断る
+- --drop-legacy は移行元の全行がコピー済みか確かめ、CSV に書き出してから移行元を空ける
+  （セル数の上限はスプレッドシート全体にかかるので、残したままだと履歴のセル数が倍になる）
+- 設定は app.py と同じ .streamlit/secrets.toml（gcp_service_account）
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from quiz_core import (
+    JST,
+    HISTORY_SHARDS,
+    SHARD_DIRECTORY_TTL_SEC,
+    SHARD_TABLES,
+    get_history_book,
+    load_shard_directory,
+    new_shard_layout,
+    read_legacy_rows,
+    legacy_row_keys,
+    copy_rows_to_shards,
+    write_shard_directory,
+    drop_legacy_sheet,
+)
+
+STATE_NAME = ".history_shard_migration.json"
+
+
+def load_state(path):
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return None
+
+
+def save_state(path, state):
+    """書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def copy_all(book, shards, state, only_new):
+    """
+    移行元を読んで shard にコピーし、コピー済みのキーを状態に記録する。
+    only_new なら、状態に記録済みのキー（最初に読んだ時点であった行）は飛ばす
+    """
+    for table in SHARD_TABLES:
+        header, rows = read_legacy_rows(book, table)
+        keys = legacy_row_keys(header, rows, table)
+        done = set(state["copied"].get(table, []))
+        if only_new:
+            rows = [r for r, k in zip(rows, keys) if k not in done]
+            keys = [k for k in keys if k not in done]
+        print(f"{table}: {len(rows)}行")
+        if rows:
+            copy_rows_to_shards(book, shards, table, header, rows)
+        state["copied"][table] = sorted(done | set(keys))
+
+
+def export_legacy(book, backup_dir):
+    """移行元をそのまま CSV に書き出す（消す前のバックアップ）"""
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now(JST).strftime("%Y%m%d_%H%M%S")
+    paths = []
+    for table in SHARD_TABLES:
+        header, rows = read_legacy_rows(book, table)
+        if not header:
+            continue
+        path = os.path.join(backup_dir, f"legacy_{table}_{stamp}.csv")
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            csv.writer(f).writerows([header] + rows)
+        paths.append(path)
+    return paths
+
+
+def drop_legacy(book, state, backup_dir):
+    for table in SHARD_TABLES:
+        header, rows = read_legacy_rows(book, table)
+        missing = set(legacy_row_keys(header, rows, table)) - set(state["copied"].get(table, []))
+        if missing:
+            print(f"⚠️ {table}: コピーされていない行が {len(missing)}件あります。--resume で続きを行ってから実行してください。",
+                  file=sys.stderr)
+            return 1
+    for path in export_legacy(book, backup_dir):
+        print(f"💾 {path} に書き出しました")
+    for table in SHARD_TABLES:
+        drop_legacy_sheet(book, table)
+    print("🧹 移行元のシートを空にしました")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="履歴・成績シートをユーザーごとのワークシートに分割します")
+    parser.add_argument("--shards", type=int, default=HISTORY_SHARDS, help=f"分割数（既定: {HISTORY_SHARDS}）")
+    parser.add_argument("--wait", type=int, default=SHARD_DIRECTORY_TTL_SEC + 5,
+                        help="切り替え後、追加分をコピーするまで待つ秒数（アプリを止めているなら 0）")
+    parser.add_argument("--resume", action="store_true", help="切り替え後に止まった移行の続き（追加分のコピー）を行う")
+    parser.add_argument("--drop-legacy", action="store_true", help="コピー済みを確認し、CSVに書き出してから移行元を空ける")
+    parser.add_argument("--backup-dir", default=".", help="--drop-legacy の CSV の書き出し先（既定: カレント）")
+    parser.add_argument("--state", default=STATE_NAME, help=f"状態ファイル（既定: {STATE_NAME}）")
+    args = parser.parse_args(argv)
+    if args.shards < 1:
+        parser.error("--shards は1以上にしてください")
+
+    book = get_history_book()
+    shards = load_shard_directory(book, refresh=True)
+    state = load_state(args.state)
+
+    if args.drop_legacy:
+        if state and state.get("phase") == "dropped":
+            print("移行元のシートは既に空にしてあります。")
+            return 0
+        if not shards or not state or state.get("phase") != "done":
+            print("移行が終わっていません。先に移行（または --resume）を行ってください。", file=sys.stderr)
+            return 1
+        code = drop_legacy(book, state, args.backup_dir)
+        if code == 0:
+            state["phase"] = "dropped"
+            save_state(args.state, state)
+        return code
+
+    if shards:
+        # 切り替え後：状態ファイルに記録した「最初に読んだ時点のキー」以外だけをコピーする
+        if not args.resume:
+            print("対応表（history_directory）が既にあるので移行済みです。切り替え後にもう一度コピーすると、"
+                  "その後に削除された履歴が戻ってしまいます。途中で止まった場合だけ --resume を付けてください。",
+                  file=sys.stderr)
+            return 1
+        if not state:
+            print(f"状態ファイル（{args.state}）が無いので、安全に再開できません。", file=sys.stderr)
+            return 1
+        if state.get("phase") in ("done", "dropped"):
+            print("移行は完了しています。")
+            return 0
+    else:
+        # 切り替え前：アプリはまだ移行元を使っているので、何度やり直しても（shard に無い行を足すだけで）安全。
+        # 前回の途中から始めるときは、振り分けがずれないよう前回の分割を使う
+        if not state or state.get("phase") not in ("copying", "copied"):
+            state = {"shards": new_shard_layout(args.shards), "copied": {}, "phase": "copying"}
+        elif len(state["shards"]) != args.shards:
+            print(f"前回の途中の移行（{len(state['shards'])}分割）の続きを行います")
+        state["copied"] = {}
+        shards = state["shards"]
+        save_state(args.state, state)
+        started = time.time()
+        copy_all(book, shards, state, only_new=False)
+        state["phase"] = "copied"
+        save_state(args.state, state)
+        if write_shard_directory(book, shards):
+            print(f"対応表（history_directory）を作成しました：{len(shards)}分割（{time.time() - started:.1f}秒）")
+        state["phase"] = "switched"
+        save_state(args.state, state)
+        if args.wait:
+            print(f"実行中のアプリが切り替わるまで {args.wait}秒待ってから、追加分をコピーします")
+            time.sleep(args.wait)
+
+    copy_all(book, shards, state, only_new=True)
+    state["phase"] = "done"
+    save_state(args.state, state)
+    print("✅ 移行が完了しました。確認後、--drop-legacy で移行元のシートを空けてください。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1218 @@
+"""
+PDF要約＆クイズ生成ツールの画面以外の処理（履歴シート・採点・復習・重複検出・Gemini呼び出し）。
+app.py（Streamlit画面）と batch_generate.py（コマンドライン一括生成）の両方から使う。
+設定は st.secrets（.streamlit/secrets.toml）から読むので、streamlit run 以外から使ってもよい
+"""
+import streamlit as st
+import google.generativeai as genai
+import json
+import re
+import hashlib
+import functools
+import io
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from google.oauth2.service_account import Credentials
+import gspread
+from gspread.utils import rowcol_to_a1
+
+# PDFのテキスト抽出用（任意。入っていなければPDFをそのまま送る）
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+JST = timezone(timedelta(hours=+9), 'JST')
+
+# --- Googleスプレッドシート連携 ---
+def get_gspread_client():
+    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+    credentials = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scopes)
+    return gspread.authorize(credentials)
+
+# ✅ 追加：履歴のプロセス共有キャッシュ（ユーザー単位・LRUで追い出し・書き込み時に無効化）
+# 同じユーザーの複数タブ/複数セッションで履歴を1つだけ持つ。キャッシュ内のオブジェクトは共有なので書き換えないこと
+HISTORY_CACHE_MAX_USERS = 200
+HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+@st.cache_resource
+def get_history_cache():
+    # gens：キーごとの世代。無効化/差し替えのたびに上がり、読み込み中に上がったらその結果はキャッシュしない
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "gens": {}, "bytes": 0, "hits": 0, "misses": 0}
+
+def estimate_size(obj, _seen=None) -> int:
+    """dict/list/str をたどった概算バイト数（同じオブジェクトは1回だけ数える）"""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(x, _seen) for x in obj)
+    return size
+
+def _cache_evict(cache):
+    entries = cache["entries"]
+    while entries and (len(entries) > HISTORY_CACHE_MAX_USERS or cache["bytes"] > HISTORY_CACHE_MAX_BYTES):
+        _, (_, size) = entries.popitem(last=False)
+        cache["bytes"] -= size
+
+def cached_user_data(kind: str, user_id, loader):
+    """(kind, user_id) ごとにキャッシュ。無ければ loader(user_id) で読み込む。
+    loader の例外（シートの 429 等）はそのまま投げ、失敗した結果はキャッシュしない。
+    読み込み中に書き込み（無効化）があった場合も、その結果は古い可能性があるのでキャッシュしない"""
+    cache = get_history_cache()
+    key = (kind, str(user_id))
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return cache["entries"][key][0]
+        cache["misses"] += 1
+        gen = cache["gens"].get(key, 0)
+
+    value = loader(user_id)  # シート読み込みはロックの外で
+    put_user_cache(kind, user_id, value, expected_gen=gen)
+    return value
+
+def put_user_cache(kind: str, user_id, value, expected_gen=None):
+    """
+    キャッシュを新しいオブジェクトで置き換える（共有中のオブジェクトは書き換えず、コピーを更新して差し替える）。
+    expected_gen を渡したときは、世代が変わっていたら（読み込み中に無効化された）置かずに False を返す
+    """
+    cache = get_history_cache()
+    key = (kind, str(user_id))
+    size = estimate_size(value)
+    with cache["lock"]:
+        if expected_gen is not None and cache["gens"].get(key, 0) != expected_gen:
+            return False
+        if expected_gen is None:
+            cache["gens"][key] = cache["gens"].get(key, 0) + 1
+        old = cache["entries"].pop(key, None)
+        if old:
+            cache["bytes"] -= old[1]
+        cache["entries"][key] = (value, size)
+        cache["bytes"] += size
+        _cache_evict(cache)
+    return True
+
+def invalidate_user_cache(user_id, kinds=("history", "stats")):
+    cache = get_history_cache()
+    with cache["lock"]:
+        for kind in kinds:
+            key = (kind, str(user_id))
+            cache["gens"][key] = cache["gens"].get(key, 0) + 1
+            old = cache["entries"].pop(key, None)
+            if old:
+                cache["bytes"] -= old[1]
+
+def get_user_history(user_id):
+    return cached_user_data("history", user_id, load_history_from_gs)
+
+def get_user_stats(user_id):
+    return cached_user_data("stats", user_id, load_question_stats_with_seed)
+
+def history_cache_report():
+    cache = get_history_cache()
+    with cache["lock"]:
+        return {
+            "users": len({k[1] for k in cache["entries"]}),
+            "entries": len(cache["entries"]),
+            "bytes": cache["bytes"],
+            "hits": cache["hits"],
+            "misses": cache["misses"],
+        }
+
+def process_rss_bytes():
+    """プロセスの最大常駐メモリ（取れない環境では None）"""
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    except:
+        return None
+
+# ✅ 変更：履歴の列。行は user_id+date ではなく不変の id で特定し、updated_at で同時更新を検出する
+HISTORY_HEADERS = ["user_id", "date", "title", "score", "correct", "total", "quiz_data", "summary_data", "archived", "id", "updated_at"]
+HISTORY_LOCATE_RETRIES = 3
+CONFLICT = "conflict"  # 書き込み関数の戻り値：他のタブ/ユーザーが先に更新していた
+
+# ✅ 追加：履歴・成績シートの分割。ユーザー名のハッシュで history_00〜 / question_stats_00〜 のワークシートに振り分け、
+# 読み書きはそのユーザーのシートだけにする。対応表（shard → worksheet）は history_directory シート。
+# 対応表が無ければ移行前とみなして従来どおり sheet1 / question_stats を使う（移行は migrate_history_shards.py）
+HISTORY_BOOK_NAME = "study_history_db"
+SHARD_DIRECTORY_SHEET = "history_directory"
+SHARD_DIRECTORY_HEADERS = ["shard", "worksheet", "stats_worksheet", "created_at"]
+HISTORY_SHARDS = 16             # 移行時の既定の分割数（移行後は対応表の行数が分割数）
+SHARD_DIRECTORY_TTL_SEC = 60    # 対応表の再読み込み間隔（移行を実行中のアプリに反映させるため）
+SHARD_MIGRATION_CHUNK = 500     # 移行時に append_rows 1回で書く行数
+
+def get_history_book():
+    client = get_gspread_client()
+    return client.open(HISTORY_BOOK_NAME)
+
+@st.cache_resource
+def get_shard_directory_cache():
+    return {"lock": threading.Lock(), "shards": None, "loaded_at": 0.0}
+
+def invalidate_shard_directory():
+    cache = get_shard_directory_cache()
+    with cache["lock"]:
+        cache["shards"] = None
+
+def load_shard_directory(book=None, refresh=False):
+    """shard 番号順に {"history": 履歴のワークシート名, "stats": 成績のワークシート名} のリストを返す（移行前なら []）"""
+    cache = get_shard_directory_cache()
+    with cache["lock"]:
+        if not refresh and cache["shards"] is not None and time.time() - cache["loaded_at"] < SHARD_DIRECTORY_TTL_SEC:
+            return cache["shards"]
+    book = book or get_history_book()
+    try:
+        records = book.worksheet(SHARD_DIRECTORY_SHEET).get_all_records()
+        shards = [
+            {"history": str(r["worksheet"]), "stats": str(r.get("stats_worksheet") or "")}
+            for r in sorted(records, key=lambda r: int(r["shard"]))
+        ]
+    except gspread.exceptions.WorksheetNotFound:
+        shards = []
+    with cache["lock"]:
+        cache["shards"] = shards
+        cache["loaded_at"] = time.time()
+    return shards
+
+def shard_of(user_id, n_shards) -> int:
+    """ユーザー名 → shard 番号（プロセスをまたいでも同じになるよう hash() ではなく sha1）"""
+    return int(hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:8], 16) % n_shards
+
+def _history_sheet_in(book, shards, user_id):
+    if not shards:
+        return book.sheet1
+    return book.worksheet(shards[shard_of(user_id, len(shards))]["history"])
+
+def get_history_sheet(user_id):
+    """user_id の履歴が入っているワークシート（移行前は sheet1）"""
+    book = get_history_book()
+    return _history_sheet_in(book, load_shard_directory(book), user_id)
+
+def new_row_id() -> str:
+    return uuid.uuid4().hex
+
+def now_stamp() -> str:
+    return datetime.now(JST).isoformat(timespec="microseconds")
+
+# ✅ 変更：archived / id / updated_at 列を保証（無ければヘッダーに追加）してヘッダーを返す
+def ensure_history_columns(sheet):
+    headers = sheet.row_values(1)
+    for h in HISTORY_HEADERS:
+        if h not in headers:
+            headers.append(h)
+            sheet.update_cell(1, len(headers), h)
+    return headers
+
+# ✅ 追加：id → 行番号の対応表（プロセス共有）。行削除でずれるので、使う前に id セルで必ず確認する
+# ✅ 変更：ワークシート（shard）ごとに持つ
+@st.cache_resource
+def get_row_index():
+    return {"lock": threading.Lock(), "sheets": {}, "locks": {}}
+
+def sheet_write_lock(sheet):
+    """
+    ワークシートごとのロック（このプロセス内で共有）。行番号で書く処理は、行の確認から書き込み/削除までこれを持つ。
+    Streamlit のセッションは同じプロセスなので、他セッションの delete_rows で行がずれて別の行に書く事故はこれで防げる。
+    別プロセス（batch_generate.py や複数台での運用）とは排他にならないので、その間は id / updated_at の確認が頼り
+    """
+    index = get_row_index()
+    with index["lock"]:
+        return index["locks"].setdefault(sheet.title, threading.RLock())
+
+def invalidate_row_index(sheet=None):
+    """sheet を渡せばそのワークシートの分だけ、省略時は全部捨てる"""
+    index = get_row_index()
+    with index["lock"]:
+        if sheet is None:
+            index["sheets"] = {}
+        else:
+            index["sheets"].pop(sheet.title, None)
+
+def _rebuild_row_index(sheet, id_col):
+    ids = sheet.col_values(id_col)
+    rows = {v: i + 1 for i, v in enumerate(ids) if i > 0 and v}
+    index = get_row_index()
+    with index["lock"]:
+        index["sheets"][sheet.title] = rows
+    return rows
+
+def locate_history_row(sheet, headers, row_id):
+    """id の行番号と現在の updated_at を返す（見つからなければ (None, None)）"""
+    id_col = headers.index("id") + 1
+    upd_col = headers.index("updated_at") + 1
+    index = get_row_index()
+    with index["lock"]:
+        rows = index["sheets"].get(sheet.title, {})
+    for _ in range(HISTORY_LOCATE_RETRIES):
+        row = rows.get(row_id)
+        if row is not None:
+            id_cell, upd_cell = sheet.batch_get([rowcol_to_a1(row, id_col), rowcol_to_a1(row, upd_col)])
+            cur_id = id_cell[0][0] if id_cell and id_cell[0] else ""
+            cur_upd = upd_cell[0][0] if upd_cell and upd_cell[0] else ""
+            if cur_id == row_id:
+                return row, cur_upd
+        # 対応表が古い（他セッションの削除で行がずれた等）→ 作り直して再確認
+        rows = _rebuild_row_index(sheet, id_col)
+        if row_id not in rows:
+            return None, None
+    return None, None
+
+# ✅ 追加：既存行への id / updated_at の付与（移行。何度実行しても空欄の行だけ埋める）
+def migrate_history_row_ids(sheet=None):
+    sheet = sheet or get_history_book().sheet1
+    headers = ensure_history_columns(sheet)
+    id_col = headers.index("id") + 1
+    upd_col = headers.index("updated_at") + 1
+
+    with sheet_write_lock(sheet):
+        n_rows = len(sheet.col_values(1))
+        ids = sheet.col_values(id_col)
+        stamp = now_stamp()
+        updates = []
+        for row in range(2, n_rows + 1):
+            if row > len(ids) or not ids[row - 1]:
+                updates.append({"range": rowcol_to_a1(row, id_col), "values": [[new_row_id()]]})
+                updates.append({"range": rowcol_to_a1(row, upd_col), "values": [[stamp]]})
+        for i in range(0, len(updates), 1000):
+            sheet.batch_update(updates[i:i + 1000])
+    if updates:
+        invalidate_row_index(sheet)
+    return len(updates) // 2
+
+def load_history_from_gs(user_id):
+    """ユーザーの履歴を読み込む。シートの読み込みに失敗したら例外を投げる（空の結果をキャッシュしないため）"""
+    sheet = get_history_sheet(user_id)
+    headers = ensure_history_columns(sheet)  # ✅ 追加
+    # id（16進）が数字だけ等のときに数値へ変換されないようにする
+    keep_text = [headers.index("id") + 1]
+    records = sheet.get_all_records(numericise_ignore=keep_text)
+
+    # ✅ 追加：id の無い行（移行前のデータ）があれば付与してから読み直す
+    if any(str(r.get("user_id")) == str(user_id) and not r.get("id") for r in records):
+        migrate_history_row_ids(sheet)
+        records = sheet.get_all_records(numericise_ignore=keep_text)
+
+    user_history = []
+    for r in records:
+        if str(r.get("user_id")) == str(user_id):
+            # ✅ 追加：アーカイブはロードはする（表示側でフィルタもできるが一応残す）
+            q_data = r.get("quiz_data", "[]")
+            if isinstance(q_data, str):
+                try:
+                    q_data = json.loads(q_data)
+                except:
+                    q_data = []
+            user_history.append({
+                "id": str(r.get("id")),
+                "updated_at": str(r.get("updated_at", "")),
+                "date": r.get("date"),
+                "title": r.get("title", "無題"),
+                "score": r.get("score"),
+                "correct": r.get("correct"),
+                "total": r.get("total"),
+                "quiz_data": q_data,
+                "summary_data": r.get("summary_data"),
+                "archived": r.get("archived", False)  # ✅ 追加
+            })
+    return user_history
+
+def _history_row(headers, user_id, log_entry, row_id, stamp):
+    """ヘッダーの並びどおりに1行分の値を作る"""
+    values = {
+        "user_id": user_id,
+        "date": log_entry["date"],
+        "title": log_entry.get("title", "無題"),
+        "score": log_entry.get("score", ""),
+        "correct": log_entry.get("correct", ""),
+        "total": log_entry.get("total", ""),
+        "quiz_data": json.dumps(log_entry.get("quiz_data", []), ensure_ascii=False),
+        "summary_data": log_entry.get("summary_data", ""),
+        "archived": "",  # ← False じゃなく空欄にする
+        "id": row_id,
+        "updated_at": stamp,
+    }
+    return [values.get(h, "") for h in headers]
+
+def save_history_to_gs(user_id, log_entry):
+    """新しい行を追加し、(id, updated_at) を返す（失敗時は (None, None)）"""
+    try:
+        sheet = get_history_sheet(user_id)
+        headers = ensure_history_columns(sheet)
+
+        row_id, stamp = new_row_id(), now_stamp()
+        sheet.append_row(_history_row(headers, user_id, log_entry, row_id, stamp))
+        invalidate_user_cache(user_id, kinds=("history",))
+        return row_id, stamp
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+        return None, None
+
+# ✅ 追加：複数件をまとめて追加（append_rows 1回）。一括生成用
+def append_history_rows_to_gs(entries):
+    """
+    entries は [(user_id, log_entry), ...]。[(id, updated_at), ...] を同じ順で返す。
+    log_entry に "id" があればその id で追加し、同じ id の行が既にあれば追加しない（やり直しでの二重追加防止）。
+    失敗時は例外をそのまま投げる（呼び出し側でやり直せるように）
+    """
+    if not entries:
+        return []
+    book = get_history_book()
+    shards = load_shard_directory(book)
+
+    # ✅ 変更：shard ごとにまとめて append_rows（ワークシート1つにつき1回）
+    groups = {}
+    for user_id, _ in entries:
+        key = shard_of(user_id, len(shards)) if shards else None
+        groups.setdefault(key, user_id)
+    sheets = {key: _history_sheet_in(book, shards, user_id) for key, user_id in groups.items()}
+    headers = {key: ensure_history_columns(sheet) for key, sheet in sheets.items()}
+
+    # id を指定された行のある shard だけ、既存の id → updated_at を読む
+    existing = {}
+    for user_id, log_entry in entries:
+        key = shard_of(user_id, len(shards)) if shards else None
+        if log_entry.get("id") and key not in existing:
+            ids = sheets[key].col_values(headers[key].index("id") + 1)
+            stamps = sheets[key].col_values(headers[key].index("updated_at") + 1)
+            existing[key] = {v: (stamps[i] if i < len(stamps) else "") for i, v in enumerate(ids) if i > 0 and v}
+
+    rows, keys = {}, []
+    for user_id, log_entry in entries:
+        key = shard_of(user_id, len(shards)) if shards else None
+        row_id = str(log_entry.get("id") or new_row_id())
+        if row_id in existing.get(key, {}):
+            keys.append((row_id, existing[key][row_id]))
+            continue
+        stamp = now_stamp()
+        rows.setdefault(key, []).append(_history_row(headers[key], user_id, log_entry, row_id, stamp))
+        keys.append((row_id, stamp))
+    for key, sheet_rows in rows.items():
+        sheets[key].append_rows(sheet_rows)
+    for user_id in {str(u) for u, _ in entries}:
+        invalidate_user_cache(user_id, kinds=("history",))
+    return keys
+
+def update_history_row_in_gs(user_id, row_id, fields: dict, expected_updated_at=None):
+    """
+    id で行を特定して fields の列だけ書き込む。
+    - 成功：新しい updated_at を返す
+    - expected_updated_at と現在値が違う：CONFLICT を返す（書き込まない）
+    - 行が無い/失敗：None
+    行の確認から書き込みまで sheet_write_lock を持つ（このプロセス内の他セッションの削除で行がずれないように）
+    """
+    try:
+        sheet = get_history_sheet(user_id)
+        headers = ensure_history_columns(sheet)
+        with sheet_write_lock(sheet):
+            row, cur_upd = locate_history_row(sheet, headers, row_id)
+            if row is None:
+                return None
+            if expected_updated_at is not None and str(cur_upd) != str(expected_updated_at):
+                invalidate_user_cache(user_id, kinds=("history",))
+                return CONFLICT
+
+            stamp = now_stamp()
+            data = [
+                {"range": rowcol_to_a1(row, headers.index(k) + 1), "values": [[v]]}
+                for k, v in dict(fields, updated_at=stamp).items()
+            ]
+            sheet.batch_update(data)
+        invalidate_user_cache(user_id, kinds=("history",))
+        return stamp
+    except:
+        return None
+
+def update_title_in_gs(user_id, row_id, new_title, expected_updated_at=None):
+    return update_history_row_in_gs(user_id, row_id, {"title": new_title}, expected_updated_at)
+
+def clear_history_from_gs(user_id):
+    try:
+        sheet = get_history_sheet(user_id)
+        ensure_history_columns(sheet)  # ✅ 追加
+
+        with sheet_write_lock(sheet):
+            cells = sheet.findall(str(user_id))
+            rows_to_delete = sorted(list(set([cell.row for cell in cells])), reverse=True)
+            for row_idx in rows_to_delete:
+                if str(sheet.cell(row_idx, 1).value) == str(user_id):
+                    sheet.delete_rows(row_idx)
+            invalidate_row_index(sheet)
+        invalidate_user_cache(user_id, kinds=("history",))
+        return True
+    except:
+        return False
+
+# ✅ 変更：削除ではなく「アーカイブ」(行は残す)
+def archive_one_history_in_gs(user_id, row_id, expected_updated_at=None):
+    return update_history_row_in_gs(user_id, row_id, {"archived": True}, expected_updated_at)
+
+# 👇 ここを追加（入れ替えじゃない）
+def restore_one_history_in_gs(user_id, row_id, expected_updated_at=None):
+    return update_history_row_in_gs(user_id, row_id, {"archived": ""}, expected_updated_at)
+
+# ✅ 追加：1件を完全削除（id で行を確認してから消す）
+def delete_one_history_in_gs(user_id, row_id, expected_updated_at=None):
+    try:
+        sheet = get_history_sheet(user_id)
+        headers = ensure_history_columns(sheet)
+        with sheet_write_lock(sheet):
+            row, cur_upd = locate_history_row(sheet, headers, row_id)
+            if row is None:
+                return None
+            if expected_updated_at is not None and str(cur_upd) != str(expected_updated_at):
+                invalidate_user_cache(user_id, kinds=("history",))
+                return CONFLICT
+            sheet.delete_rows(row)
+            invalidate_row_index(sheet)  # 下の行がずれるので対応表は作り直し
+        invalidate_user_cache(user_id, kinds=("history",))
+        return True
+    except:
+        return None
+
+# ✅ 追加：生成時点で「作成」、以後は同じ行を「上書き」する（採点もここで上書き）
+def upsert_history_in_gs(user_id, row_id, log_entry, expected_updated_at=None):
+    """
+    id で行を特定し、
+    - 存在すれば：タイトル/スコア/正解数/総数/quiz_data/summary_data を上書き（updated_at を返す / 競合なら CONFLICT）
+    - 無ければ：append で新規作成（新しい id, updated_at を返す）
+    """
+    fields = {
+        "title": log_entry.get("title", "無題"),
+        "score": log_entry.get("score", ""),
+        "correct": log_entry.get("correct", ""),
+        "total": log_entry.get("total", ""),
+        "quiz_data": json.dumps(log_entry.get("quiz_data", []), ensure_ascii=False),
+        "summary_data": log_entry.get("summary_data", ""),
+    }
+    if row_id:
+        res = update_history_row_in_gs(user_id, row_id, fields, expected_updated_at)
+        if res is not None:
+            return row_id, res
+    return save_history_to_gs(user_id, log_entry)
+
+# ✅ 追加：ローカル採点エンジン（正規化キーは作成/編集時に1回だけ計算して answer_norm に保存）
+# 記述式の類似度しきい値（1.0 で完全一致のみ）。secrets.toml の ANSWER_MATCH_THRESHOLD で変更可
+try:
+    ANSWER_MATCH_THRESHOLD = float(st.secrets.get("ANSWER_MATCH_THRESHOLD", 0.85))
+except:
+    ANSWER_MATCH_THRESHOLD = 0.85
+
+# カタカナ → ひらがな（ァ〜ヶ を 0x60 ずらす）
+_KANA_FOLD = {c: c - 0x60 for c in range(ord("ァ"), ord("ヶ") + 1)}
+# 空白・句読点・括弧類は採点に関係ないので削除（NFKC後に残る全角記号も含む）
+_ANSWER_DROP = {ord(c): None for c in " \t\r\n　・、。!?！？「」『』()（）[]【】〔〕\"'“”‘’`_;"}
+_ANSWER_TABLE = {**_KANA_FOLD, **_ANSWER_DROP}
+# 小数点・符号・分数・比・桁区切り・範囲は数字の隣にあれば意味があるので残す（"1.5" と "15" を区別）
+_ANSWER_DROP_NOT_NUMERIC = re.compile(r"(?<![0-9])[.,\-/:~〜](?![0-9])")
+# 数字・英字の並び（年号・数値・略語）。ここは1文字違えば別の答えなので、あいまい一致の対象にしない
+_ANSWER_EXACT_RUNS = re.compile(r"[0-9a-z]+")
+# 保存済みの answer_norm がどの規則で作られたか（規則を変えたら上げる。古いキーは採点時に作り直す）
+ANSWER_NORM_VERSION = 2
+# 問題の指紋は成績シートのキーなので、規則を変えても旧規則のまま固定する
+_FINGERPRINT_TABLE = {**_KANA_FOLD, **{ord(c): None for c in " \t\r\n　・、。,.!?！？「」『』()（）[]【】〔〕\"'“”‘’`~〜-_/:;"}}
+
+def norm_answer(s: str) -> str:
+    """採点用：表記ゆれを軽減（全角/半角・カタカナ/ひらがな・空白/記号）"""
+    s = unicodedata.normalize("NFKC", str(s or "")).lower()
+    return _ANSWER_DROP_NOT_NUMERIC.sub("", s.translate(_ANSWER_TABLE))
+
+def attach_answer_norm(q: dict) -> dict:
+    """問題dictに正規化済みの正解キーを付与（作成/編集/追加時に呼ぶ）"""
+    q["answer_norm"] = norm_answer(q.get("answer", ""))
+    q["answer_norm_v"] = ANSWER_NORM_VERSION
+    return q
+
+def answer_key(q: dict) -> str:
+    """保存済みの正規化キー（無い/古い規則のものは作り直す）"""
+    if q.get("answer_norm") is None or q.get("answer_norm_v") != ANSWER_NORM_VERSION:
+        return norm_answer(q.get("answer", ""))
+    return q["answer_norm"]
+
+def bounded_edit_distance(a: str, b: str, max_dist: int) -> int:
+    """編集距離（max_dist を超えたら max_dist+1 で打ち切り、帯域のみ計算）"""
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    if len(a) > len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    big = max_dist + 1
+    for i in range(1, len(a) + 1):
+        lo = max(1, i - max_dist)
+        hi = min(len(b), i + max_dist)
+        cur = [big] * (len(b) + 1)
+        if lo == 1:
+            cur[0] = i
+        row_min = cur[0]
+        ca = a[i - 1]
+        for j in range(lo, hi + 1):
+            cost = 0 if ca == b[j - 1] else 1
+            v = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            cur[j] = v
+            if v < row_min:
+                row_min = v
+        if row_min > max_dist:
+            return big
+        prev = cur
+    return min(prev[len(b)], big)
+
+def match_choice(user_ans, q: dict) -> bool:
+    """選択式：選んだ選択肢の文字列を answer とそのまま比べる（正規化すると別の選択肢と一致しうる）"""
+    opts = [str(o).strip() for o in q.get("options", [])]
+    answer = str(q.get("answer", "")).strip()
+    picked = str(user_ans or "").strip()
+    if answer in opts:
+        return picked == answer
+    # answer が選択肢と字面で一致しない（LLMの表記ゆれ）ときだけ、正規化で一致する選択肢が1つに決まれば採用
+    key = answer_key(q)
+    hits = [o for o in opts if norm_answer(o) == key]
+    return len(hits) == 1 and picked == hits[0]
+
+def match_answer(user_ans, q: dict, threshold: float = None) -> bool:
+    """1問を採点。選択式は選択肢の完全一致、記述式は編集距離ベースの類似度で判定"""
+    opts = q.get("options", [])
+    if opts and isinstance(opts, list) and len(opts) >= 2:
+        return match_choice(user_ans, q)
+    if threshold is None:
+        threshold = ANSWER_MATCH_THRESHOLD
+    key = answer_key(q)
+    ans = norm_answer(user_ans)
+    if ans == key:
+        return True
+    if not ans or not key:
+        return False
+    # "2024年4月1日" と "…2日"、"DNA…" と "RNA…" のような違いは許さない（編集距離はかな・漢字の表記ゆれ用）
+    if _ANSWER_EXACT_RUNS.findall(ans) != _ANSWER_EXACT_RUNS.findall(key):
+        return False
+    longest = max(len(ans), len(key))
+    max_dist = int(longest * (1 - threshold) + 1e-9)
+    if max_dist <= 0:
+        return False
+    return bounded_edit_distance(ans, key, max_dist) <= max_dist
+
+# ✅ 追加：問題ごとの成績インデックス（問題の指紋ごとに集計し、採点のたびに差分だけ更新）
+STATS_SHEET_NAME = "question_stats"
+STATS_HEADERS = ["user_id", "fingerprint", "attempts", "correct", "last_seen", "ease", "interval", "due", "question_data"]
+REVIEW_LIMIT = 20  # 「今日の復習」1回あたりの最大問題数
+
+def question_fingerprint(q: dict) -> str:
+    """問題文＋正解の正規化キーから問題の指紋を作る（履歴をまたいで同じ問題を同一視する）"""
+    def fold(t):
+        return unicodedata.normalize("NFKC", str(t or "")).lower().translate(_FINGERPRINT_TABLE)
+    base = fold(q.get("question", "")) + "\x1f" + fold(q.get("answer", ""))
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+
+def get_stats_sheet(user_id):
+    """user_id の成績インデックスが入っているワークシート（移行前は question_stats。無ければ作成）"""
+    book = get_history_book()
+    shards = load_shard_directory(book)
+    if shards and shards[shard_of(user_id, len(shards))]["stats"]:
+        return book.worksheet(shards[shard_of(user_id, len(shards))]["stats"])
+    try:
+        return book.worksheet(STATS_SHEET_NAME)
+    except gspread.exceptions.WorksheetNotFound:
+        ws = book.add_worksheet(title=STATS_SHEET_NAME, rows=1000, cols=len(STATS_HEADERS))
+        ws.append_row(STATS_HEADERS)
+        return ws
+
+def load_question_stats(user_id):
+    """ユーザーの成績インデックスを {fingerprint: entry} で返す（読み込み失敗時は例外）"""
+    sheet = get_stats_sheet(user_id)
+    stats = {}
+    # 指紋（16進）が "1234…" や "12e4…" のとき数値に変換されて一致しなくなるので、全列を文字列のまま読む
+    for r in sheet.get_all_records(numericise_ignore=["all"]):
+        if str(r.get("user_id")) != str(user_id):
+            continue
+        try:
+            q_data = json.loads(r.get("question_data") or "{}")
+        except:
+            q_data = {}
+        stats[str(r.get("fingerprint"))] = {
+            "attempts": int(r.get("attempts") or 0),
+            "correct": int(r.get("correct") or 0),
+            "last_seen": str(r.get("last_seen") or ""),
+            "ease": float(r.get("ease") or 2.5),
+            "interval": int(r.get("interval") or 0),
+            "due": str(r.get("due") or ""),
+            "question": q_data,
+        }
+    return stats
+
+def save_question_stats(user_id, stats, fingerprints):
+    """変更のあった指紋の行だけを書き込む（既存行は batch_update、新規は append_rows）"""
+    if not fingerprints:
+        return True
+    try:
+        sheet = get_stats_sheet(user_id)
+        keys = sheet.get_values("A:B")
+        row_of = {(r[0], r[1]): i + 1 for i, r in enumerate(keys) if len(r) >= 2}
+
+        updates, appends = [], []
+        for fp in fingerprints:
+            e = stats[fp]
+            row = [
+                user_id, fp, e["attempts"], e["correct"], e["last_seen"],
+                round(e["ease"], 2), e["interval"], e["due"],
+                json.dumps(e["question"], ensure_ascii=False)
+            ]
+            target_row = row_of.get((str(user_id), fp))
+            if target_row:
+                updates.append({"range": f"A{target_row}:I{target_row}", "values": [row]})
+            else:
+                appends.append(row)
+
+        if updates:
+            sheet.batch_update(updates)
+        if appends:
+            sheet.append_rows(appends)
+        return True
+    except:
+        return False
+
+def load_question_stats_with_seed(user_id):
+    """インデックスが空なら既存の履歴から1回だけ作って保存する"""
+    stats = load_question_stats(user_id)
+    if not stats:
+        history = get_user_history(user_id)
+        if history:
+            save_question_stats(user_id, stats, seed_question_stats(stats, history))
+    return stats
+
+def clear_question_stats(user_id):
+    try:
+        sheet = get_stats_sheet(user_id)
+        col = sheet.col_values(1)
+        for row_idx in range(len(col), 1, -1):
+            if str(col[row_idx - 1]) == str(user_id):
+                sheet.delete_rows(row_idx)
+        invalidate_user_cache(user_id, kinds=("stats",))
+        return True
+    except:
+        return False
+
+def review_step(entry: dict, is_correct: bool, day: str):
+    """SM-2 を簡略化した間隔反復。正解なら間隔を伸ばし、不正解なら翌日に戻す"""
+    entry["attempts"] += 1
+    entry["last_seen"] = day
+    if is_correct:
+        entry["correct"] += 1
+        if entry["interval"] <= 0:
+            entry["interval"] = 1
+        elif entry["interval"] == 1:
+            entry["interval"] = 3
+        else:
+            entry["interval"] = int(round(entry["interval"] * entry["ease"]))
+        entry["ease"] = min(3.0, entry["ease"] + 0.1)
+    else:
+        entry["interval"] = 1
+        entry["ease"] = max(1.3, entry["ease"] - 0.2)
+    due = datetime.strptime(day, "%Y/%m/%d") + timedelta(days=entry["interval"])
+    entry["due"] = due.strftime("%Y/%m/%d")
+
+def record_grades(stats: dict, quiz: list, day: str):
+    """採点済みの問題をインデックスに反映し、変更した指紋を返す"""
+    changed = []
+    for q in quiz:
+        if "is_correct" not in q:
+            continue
+        fp = question_fingerprint(q)
+        entry = stats.get(fp)
+        if entry is None:
+            entry = {"attempts": 0, "correct": 0, "last_seen": "", "ease": 2.5, "interval": 0, "due": ""}
+            stats[fp] = entry
+        entry["question"] = {k: v for k, v in q.items() if k not in ("user_ans", "is_correct", "dup_of")}
+        review_step(entry, bool(q.get("is_correct")), day)
+        if fp not in changed:
+            changed.append(fp)
+    return changed
+
+def seed_question_stats(stats: dict, history: list):
+    """インデックスが空のユーザー用：既存の履歴から1回だけ作る（古い順に反映）"""
+    changed = []
+    for log in sorted(history, key=lambda h: str(h.get("date", ""))):
+        q_data = log.get("quiz_data")
+        if not isinstance(q_data, list):
+            continue
+        day = str(log.get("date", ""))[:10]
+        try:
+            datetime.strptime(day, "%Y/%m/%d")
+        except:
+            continue
+        for fp in record_grades(stats, [q for q in q_data if isinstance(q, dict)], day):
+            if fp not in changed:
+                changed.append(fp)
+    return changed
+
+def due_review_questions(stats: dict, day: str, limit: int = REVIEW_LIMIT):
+    """今日が期限の問題（期限の古い順・苦手な順）"""
+    due = [e for e in stats.values() if e.get("due") and e["due"] <= day and e.get("question")]
+    due.sort(key=lambda e: (e["due"], e["ease"]))
+    return [dict(e["question"]) for e in due[:limit]]
+
+# ✅ 追加：ほぼ同じ問題の検出（文字3-gram の MinHash + LSH。候補だけ Jaccard で確認）
+# 問題文が似ているだけでは重複にしない：問題文中の数字・英字（"第9条" と "第19条"）、正解、選択肢（順不同）も一致が必要
+DUP_THRESHOLD = 0.8   # 問題文の Jaccard 類似度がこれ以上なら重複扱い
+_MINHASH_PERM = 64
+_LSH_BANDS = 16       # 16バンド×4行 → 類似度0.5前後から候補に上がる
+_LSH_ROWS = _MINHASH_PERM // _LSH_BANDS
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_COEF = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MINHASH_PRIME or 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MINHASH_PRIME)
+    for i in range(_MINHASH_PERM)
+]
+
+@functools.lru_cache(maxsize=20000)
+def _question_signature(text: str):
+    """正規化済み問題文 → (shingle集合, MinHashシグネチャ)。同じ文は計算し直さない"""
+    if len(text) < 3:
+        shingles = frozenset([text])
+    else:
+        shingles = frozenset(text[i:i + 3] for i in range(len(text) - 2))
+    hashes = [int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big") for sh in shingles]
+    sig = tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_COEF)
+    return shingles, sig
+
+def question_signature(q: dict):
+    return _question_signature(norm_answer(q.get("question", "")))
+
+def _dup_exact_key(q: dict):
+    """問題文の類似度とは別に、完全に一致していないと重複にしない部分"""
+    opts = q.get("options", [])
+    return (
+        tuple(_ANSWER_EXACT_RUNS.findall(norm_answer(q.get("question", "")))),
+        answer_key(q),
+        frozenset(norm_answer(o) for o in opts) if isinstance(opts, list) else frozenset(),
+    )
+
+def new_dup_index():
+    return {"buckets": {}, "items": []}
+
+def find_near_duplicate(index: dict, q: dict, threshold: float = DUP_THRESHOLD):
+    """インデックス内のほぼ同じ問題の payload を返す（無ければ None）。同じバケットの候補だけ比較する"""
+    shingles, sig = question_signature(q)
+    exact = _dup_exact_key(q)
+    seen = set()
+    for band in range(_LSH_BANDS):
+        key = (band, sig[band * _LSH_ROWS:(band + 1) * _LSH_ROWS])
+        for item_id in index["buckets"].get(key, ()):
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            other, other_exact, payload = index["items"][item_id]
+            if other_exact == exact and len(shingles & other) / len(shingles | other) >= threshold:
+                return payload
+    return None
+
+def add_to_dup_index(index: dict, q: dict, payload):
+    shingles, sig = question_signature(q)
+    item_id = len(index["items"])
+    index["items"].append((shingles, _dup_exact_key(q), payload))
+    for band in range(_LSH_BANDS):
+        key = (band, sig[band * _LSH_ROWS:(band + 1) * _LSH_ROWS])
+        index["buckets"].setdefault(key, []).append(item_id)
+
+def build_quiz_dup_index(quiz: list):
+    """表示中のクイズでインデックスを作る（payload は問題番号）"""
+    index = new_dup_index()
+    for i, q in enumerate(quiz or []):
+        add_to_dup_index(index, q, i)
+    return index
+
+def build_history_dup_index(history: list):
+    """履歴の全問題でインデックスを作る（payload は出題元のタイトル）"""
+    index = new_dup_index()
+    for log in history or []:
+        q_data = log.get("quiz_data")
+        if not isinstance(q_data, list):
+            continue
+        for q in q_data:
+            if isinstance(q, dict):
+                add_to_dup_index(index, q, log.get("title", "無題"))
+    return index
+
+def dedup_new_quiz(quiz: list, history_index: dict):
+    """生成直後のクイズ：クイズ内の重複は削除、過去の履歴と重複する問題は dup_of で印を付ける"""
+    own_index = new_dup_index()
+    kept, dropped = [], 0
+    for q in quiz:
+        if find_near_duplicate(own_index, q) is not None:
+            dropped += 1
+            continue
+        add_to_dup_index(own_index, q, len(kept))
+        src = find_near_duplicate(history_index, q)
+        if src is not None:
+            q["dup_of"] = src
+        kept.append(q)
+    return kept, dropped
+
+def dedup_history(history: list, include_archived: bool = False):
+    """履歴全体の重複問題を削除。残す優先度は 未アーカイブ→アーカイブ、それぞれ新しい順。
+    アーカイブ行は再挑戦前の解答記録（user_ans / is_correct）なので、既定では対象外にして触らない。
+    変更のあった {id: (quiz_data, updated_at)} と削除数を返す"""
+    order = sorted(
+        [h for h in history if isinstance(h.get("quiz_data"), list) and (include_archived or not h.get("archived"))],
+        key=lambda h: str(h.get("date", "")), reverse=True
+    )
+    order.sort(key=lambda h: bool(h.get("archived")))
+
+    index = new_dup_index()
+    changed, removed = {}, 0
+    for log in order:
+        kept = []
+        for q in log["quiz_data"]:
+            if not isinstance(q, dict):
+                continue
+            if find_near_duplicate(index, q) is not None:
+                removed += 1
+                continue
+            add_to_dup_index(index, q, log.get("id"))
+            kept.append(q)
+        if len(kept) != len(log["quiz_data"]):
+            changed[str(log.get("id"))] = (kept, log.get("updated_at"))
+    return changed, removed
+
+def bulk_update_quiz_data_in_gs(user_id, changes: dict):
+    """
+    quiz_data 列をまとめて上書き（id/updated_at 列の読み込み1回 + batch_update）。
+    changes は {id: (quiz_data, 読み込み時の updated_at)}。その後に更新された行は飛ばし、飛ばした件数を返す
+    （失敗時は None）
+    """
+    if not changes:
+        return 0
+    try:
+        sheet = get_history_sheet(user_id)
+        headers = ensure_history_columns(sheet)
+        id_col = headers.index("id") + 1
+        upd_col = headers.index("updated_at") + 1
+        q_col = headers.index("quiz_data") + 1
+
+        with sheet_write_lock(sheet):  # id 列の読み込みから書き込みまで（行番号で書くので）
+            ids = sheet.col_values(id_col)
+            stamps = sheet.col_values(upd_col)
+            stamp = now_stamp()
+            updates, skipped = [], 0
+            for i, row_id in enumerate(ids):
+                if i == 0 or row_id not in changes:
+                    continue
+                quiz_data, expected = changes[row_id]
+                cur_upd = stamps[i] if i < len(stamps) else ""
+                if expected is not None and str(cur_upd) != str(expected):
+                    skipped += 1
+                    continue
+                updates.append({"range": rowcol_to_a1(i + 1, q_col), "values": [[json.dumps(quiz_data, ensure_ascii=False)]]})
+                updates.append({"range": rowcol_to_a1(i + 1, upd_col), "values": [[stamp]]})
+            if updates:
+                sheet.batch_update(updates)
+        invalidate_user_cache(user_id, kinds=("history",))
+        return skipped
+    except:
+        return None
+
+# ✅ 追加：sheet1 / question_stats → shard への移行（手順と再開は migrate_history_shards.py。ここはシート操作だけ）
+# 行のキーは履歴が id、成績が user_id + 指紋。shard 側に同じキーがあれば書かない
+SHARD_TABLES = {
+    "history": {"headers": HISTORY_HEADERS, "keys": ("id",)},
+    "stats": {"headers": STATS_HEADERS, "keys": ("user_id", "fingerprint")},
+}
+
+def new_shard_layout(n_shards):
+    return [{"history": f"history_{i:02d}", "stats": f"question_stats_{i:02d}"} for i in range(n_shards)]
+
+def get_legacy_sheet(book, table):
+    """移行元のワークシート（履歴は sheet1、成績は question_stats。無ければ None）"""
+    if table == "history":
+        return book.sheet1
+    try:
+        return book.worksheet(STATS_SHEET_NAME)
+    except gspread.exceptions.WorksheetNotFound:
+        return None
+
+def _row_key(header, row, table):
+    return "\x1f".join(str(row[header.index(k)]) if header.index(k) < len(row) else "" for k in SHARD_TABLES[table]["keys"])
+
+def read_legacy_rows(book, table):
+    """移行元を1回でまとめて読む。(ヘッダー, 行のリスト) を返す（無ければ ([], [])）"""
+    sheet = get_legacy_sheet(book, table)
+    if sheet is None:
+        return [], []
+    if table == "history":
+        migrate_history_row_ids(sheet)  # id の無い行に先に付与（shard 側での重複判定に使う）
+    values = sheet.get_all_values()
+    if not values:
+        return [], []
+    header = values[0]
+    return header, [r + [""] * (len(header) - len(r)) for r in values[1:] if any(r)]
+
+def legacy_row_keys(header, rows, table):
+    return [_row_key(header, r, table) for r in rows]
+
+def ensure_shard_worksheets(book, shards, tables=SHARD_TABLES):
+    """
+    shard のワークシートを（行が無くても）見出し付きで作っておく。{タイトル: ワークシート} を返す。
+    切り替え後は get_stats_sheet などが book.worksheet で開くので、無いシートがあると読み書きが失敗する
+    """
+    sheets = {ws.title: ws for ws in book.worksheets()}
+    for table in tables:
+        headers = SHARD_TABLES[table]["headers"]
+        for layout in shards:
+            title = layout[table]
+            if title not in sheets:
+                sheets[title] = book.add_worksheet(title=title, rows=100, cols=len(headers))
+                sheets[title].append_row(headers)
+    return sheets
+
+def copy_rows_to_shards(book, shards, table, header, rows, log=print):
+    """
+    移行元の行を shard ごとに append_rows でまとめて書き込む（shard 側に同じキーがある行は飛ばす）。
+    書いた行数を返す
+    """
+    spec = SHARD_TABLES[table]
+    uid_col = header.index("user_id")
+    buckets = {}
+    for r in rows:
+        if r[uid_col]:
+            buckets.setdefault(shard_of(r[uid_col], len(shards)), []).append(r)
+
+    sheets = ensure_shard_worksheets(book, shards, [table])
+    copied = 0
+    for i, layout in enumerate(shards):
+        title, bucket = layout[table], buckets.get(i, [])
+        ws = sheets[title]
+        if not bucket:
+            continue
+        ws_values = ws.get_all_values()
+        ws_header = ws_values[0] if ws_values else list(spec["headers"])
+        have = {_row_key(ws_header, r, table) for r in ws_values[1:]}
+        pos = {h: header.index(h) for h in ws_header if h in header}
+        new_rows = [
+            [r[pos[h]] if h in pos else "" for h in ws_header]
+            for r in bucket if _row_key(header, r, table) not in have
+        ]
+        for start in range(0, len(new_rows), SHARD_MIGRATION_CHUNK):
+            ws.append_rows(new_rows[start:start + SHARD_MIGRATION_CHUNK])
+        copied += len(new_rows)
+        log(f"  {title}: {len(new_rows)}行をコピー（既存 {len(ws_values) - 1 if ws_values else 0}行）")
+    return copied
+
+def write_shard_directory(book, shards):
+    """対応表を作る（ここからアプリの読み書きが shard に切り替わる）。既にあれば何もしない。
+    移行元が空で行をコピーしなかった shard も、対応表より先にワークシートを作っておく"""
+    try:
+        book.worksheet(SHARD_DIRECTORY_SHEET)
+        return False
+    except gspread.exceptions.WorksheetNotFound:
+        pass
+    ensure_shard_worksheets(book, shards)
+    directory = book.add_worksheet(title=SHARD_DIRECTORY_SHEET, rows=len(shards) + 1, cols=len(SHARD_DIRECTORY_HEADERS))
+    stamp = now_stamp()
+    directory.append_rows([SHARD_DIRECTORY_HEADERS] + [
+        [i, layout["history"], layout["stats"], stamp] for i, layout in enumerate(shards)
+    ])
+    invalidate_shard_directory()
+    invalidate_row_index()
+    return True
+
+def drop_legacy_sheet(book, table):
+    """
+    移行元のセルを空ける（セル数の上限はスプレッドシート全体にかかるため）。
+    sheet1 は削除できない（先頭のシートが入れ替わる）ので、中身を消して1セルに縮める
+    """
+    sheet = get_legacy_sheet(book, table)
+    if sheet is None:
+        return
+    if table == "history":
+        sheet.clear()
+        sheet.resize(rows=1, cols=1)
+    else:
+        book.del_worksheet(sheet)
+
+# --- LLM出力の読み取り ---
+def parse_json_safely(res_text: str):
+    """LLM出力からJSONをできるだけ安全に抽出"""
+    t = (res_text or "").strip()
+    # コードブロック除去
+    t = t.replace("```json", "```").replace("```", "")
+    start = t.find("{")
+    end = t.rfind("}")
+    if start == -1 or end == -1 or end <= start:
+        raise ValueError("JSONが見つかりません")
+    return json.loads(t[start:end+1])
+
+# --- AI処理 ---
+# ✅ 変更：ワーカースレッドからも呼べるように、st.spinner 等の画面処理はここに入れない
+def get_available_model():
+    return genai.GenerativeModel("gemini-2.5-pro")
+
+def pdf_parts(files):
+    """アップロードされたPDFを Gemini に渡す形にする"""
+    return [{"mime_type": "application/pdf", "data": f.getvalue()} for f in files]
+
+# ✅ 追加：PDFのテキスト抽出（前処理）。文字の取れるページのうち、テキストの方が入力トークンが少ないページだけ
+# テキストで送る。スキャン/画像の多いページや文字の詰まったページはPDFのまま送る。抽出結果はファイルのハッシュでキャッシュ
+try:
+    PDF_TEXT_EXTRACTION = bool(st.secrets.get("PDF_TEXT_EXTRACTION", True))
+except:
+    PDF_TEXT_EXTRACTION = True
+PDF_PAGE_TOKENS = 258          # Gemini がPDF1ページに使う入力トークン（画像としての分）
+MIN_PAGE_CHARS = 200           # これより文字が少ないページはスキャン等とみなしてPDFのまま送る
+IMAGE_PAGE_MIN_CHARS = 800     # 画像のあるページは、これだけ文字があればテキストで十分とみなす
+PDF_TEXT_CACHE_MAX = 64
+# テキストのトークン数の見積もり（ASCII は約4文字で1トークン、日本語などはほぼ1文字1トークンと多めに見る）
+ASCII_CHARS_PER_TOKEN = 4
+PAGE_MARKER_TOKENS = 8         # "--- p.N ---" の区切り分
+
+def estimate_text_tokens(text: str) -> int:
+    t = (text or "").strip()
+    ascii_chars = sum(1 for c in t if c.isascii())
+    return -(-ascii_chars // ASCII_CHARS_PER_TOKEN) + (len(t) - ascii_chars) + PAGE_MARKER_TOKENS
+
+@st.cache_resource
+def get_pdf_text_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def _page_has_images(page) -> bool:
+    try:
+        xobjects = page["/Resources"].get("/XObject")
+        if xobjects is None:
+            return False
+        return any(x.get_object().get("/Subtype") == "/Image" for x in xobjects.get_object().values())
+    except:
+        return False
+
+def _page_text_ok(text: str, has_images: bool) -> bool:
+    t = (text or "").strip()
+    if len(t) < MIN_PAGE_CHARS:
+        return False
+    garbled = t.count("\ufffd") + t.count("(cid:")
+    if garbled > len(t) * 0.02:
+        return False
+    return not has_images or len(t) >= IMAGE_PAGE_MIN_CHARS
+
+def extract_pdf_pages(data: bytes):
+    """
+    PDFの各ページを (テキスト, テキストで送ってよいか) のリストにする（ハッシュでキャッシュ）。
+    テキストで送るのは、抽出が読めて、かつ見積もりトークン数がPDF1ページ分より少ないページだけ
+    """
+    key = hashlib.sha256(data).hexdigest()
+    cache = get_pdf_text_cache()
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            return cache["entries"][key]
+
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    pages = []
+    for page in reader.pages:
+        try:
+            text = page.extract_text() or ""
+        except:
+            text = ""
+        ok = _page_text_ok(text, _page_has_images(page)) and estimate_text_tokens(text) < PDF_PAGE_TOKENS
+        pages.append((text, ok))
+
+    with cache["lock"]:
+        cache["entries"][key] = pages
+        while len(cache["entries"]) > PDF_TEXT_CACHE_MAX:
+            cache["entries"].popitem(last=False)
+    return pages
+
+def _pdf_subset(data: bytes, page_idxs):
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    writer = pypdf.PdfWriter()
+    for i in page_idxs:
+        writer.add_page(reader.pages[i])
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def prepare_content_parts(parts):
+    """
+    PDFごとに、テキストで足りるページはテキスト、足りないページだけを抜き出したPDFにする。
+    (Geminiに渡すparts, レポート{pages, text_pages, saved_tokens}) を返す。
+    saved_tokens は「PDF1ページ分 − テキストの見積もり」をテキストで送ったページについて足したもの
+    """
+    report = {"pages": 0, "text_pages": 0, "saved_tokens": 0}
+    if pypdf is None or not PDF_TEXT_EXTRACTION:
+        return list(parts), report
+
+    out = []
+    for part in parts:
+        if not isinstance(part, dict) or part.get("mime_type") != "application/pdf":
+            out.append(part)
+            continue
+        try:
+            pages = extract_pdf_pages(part["data"])
+            good = [i for i, (_, ok) in enumerate(pages) if ok]
+            bad = [i for i, (_, ok) in enumerate(pages) if not ok]
+            converted = []
+            if good:
+                converted.append("【資料テキスト】\n" + "\n\n".join(
+                    f"--- p.{i + 1} ---\n{pages[i][0].strip()}" for i in good
+                ))
+                if bad:
+                    converted.append({"mime_type": "application/pdf", "data": _pdf_subset(part["data"], bad)})
+        except:
+            pages, good, converted = [], [], []
+
+        report["pages"] += len(pages)
+        if not good:
+            out.append(part)  # 全ページ画像/抽出失敗 → そのまま
+            continue
+        out.extend(converted)
+        report["text_pages"] += len(good)
+        report["saved_tokens"] += sum(PDF_PAGE_TOKENS - estimate_text_tokens(pages[i][0]) for i in good)
+    return out, report
+
+def _record_usage(usage, response, started):
+    if usage is None:
+        return
+    usage["seconds"] = time.time() - started
+    try:
+        usage["prompt_tokens"] = response.usage_metadata.prompt_token_count
+    except:
+        usage["prompt_tokens"] = None
+
+def generate_summary(parts, usage=None):
+    model = get_available_model()
+    if not model:
+        return None
+    content = ["資料の要点を、分かりやすく要約してください。"] + list(parts)
+    try:
+        started = time.time()
+        response = model.generate_content(content)
+        _record_usage(usage, response, started)
+        return response.text
+    except:
+        return None
+
+def start_quiz_generation(parts, usage=None):
+    model = get_available_model()
+    if not model:
+        return "無題", []
+    prompt = """PDFからクイズ15問をJSONで出力。
+【重要】記述式や穴埋め問題の場合、optionsは必ず空リスト[]にすること。
+【重要】出力はJSONのみ。前後に説明文やコードブロックは付けないこと。
+{"title": "タイトル", "quizzes": [{"question": "..", "options": ["..", ".."], "answer": "..", "explanation": ".."}]}"""
+    content = [prompt] + list(parts)
+    try:
+        started = time.time()
+        response = model.generate_content(content)
+        _record_usage(usage, response, started)
+        data = parse_json_safely(response.text)
+        return data.get("title", "無題"), data.get("quizzes", [])
+    except:
+        return "無題", []
@@ -0,0 +1,94 @@
+"""採点（norm_answer / match_answer / bounded_edit_distance）のテスト"""
+import random
+
+import pytest
+
+from quiz_core import attach_answer_norm, bounded_edit_distance, match_answer, norm_answer
+
+
+def levenshtein(a, b):
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def test_norm_answer_folds_width_kana_and_spaces():
+    assert norm_answer("ＡＢＣ　１２３") == norm_answer("abc123")
+    assert norm_answer("ミトコンドリア") == norm_answer("みとこんどりあ")
+    assert norm_answer("「光合成」。") == norm_answer("光合成")
+
+
+@pytest.mark.parametrize("a, b", [("1.5", "15"), ("-5", "5"), ("3/4", "34"), ("1:2", "12"), ("1,000", "1000")])
+def test_norm_answer_keeps_numeric_punctuation(a, b):
+    assert norm_answer(a) != norm_answer(b)
+
+
+def test_norm_answer_drops_punctuation_away_from_digits():
+    assert norm_answer("e.g. well-known") == norm_answer("eg wellknown")
+
+
+@pytest.mark.parametrize("a, b", [("1.5", "15"), ("-5", "5"), ("3/4", "34"), ("1:2", "12")])
+def test_match_answer_free_text_numbers(a, b):
+    q = attach_answer_norm({"question": "q", "answer": a})
+    assert match_answer(a, q)
+    assert not match_answer(b, q)
+
+
+def test_match_answer_free_text_fuzzy():
+    q = attach_answer_norm({"question": "q", "answer": "ミトコンドリア"})
+    assert match_answer("みとこんどりあ", q)
+    assert match_answer("ミトコンドリヤ", q, threshold=0.85)
+    assert not match_answer("ミトコンドリヤ", q, threshold=1.0)
+    assert not match_answer("", q)
+
+
+def test_match_answer_choice_is_exact():
+    q = attach_answer_norm({"question": "q", "answer": "1.5", "options": ["1.5", "15", "0.15"]})
+    assert match_answer("1.5", q)
+    assert not match_answer("15", q)
+    assert not match_answer("0.15", q)
+
+
+def test_match_answer_choice_answer_not_in_options():
+    # answer が選択肢と字面で違っても、正規化で1つに決まればその選択肢だけ正解
+    q = attach_answer_norm({"question": "q", "answer": "ｱﾃﾞﾉｼﾝ三リン酸", "options": ["アデノシン三リン酸", "アデノシン二リン酸"]})
+    assert match_answer("アデノシン三リン酸", q)
+    assert not match_answer("アデノシン二リン酸", q)
+
+
+def test_match_answer_recomputes_stale_key():
+    # 旧規則で保存された answer_norm（"1.5" → "15"）は使わない
+    q = {"question": "q", "answer": "1.5", "answer_norm": "15"}
+    assert not match_answer("15", q)
+    assert match_answer("1.5", q)
+
+
+def test_bounded_edit_distance_matches_levenshtein():
+    rng = random.Random(0)
+    for _ in range(500):
+        a = "".join(rng.choice("abc") for _ in range(rng.randint(0, 8)))
+        b = "".join(rng.choice("abc") for _ in range(rng.randint(0, 8)))
+        k = rng.randint(0, 4)
+        d = levenshtein(a, b)
+        assert bounded_edit_distance(a, b, k) == (d if d <= k else k + 1)
+
+
+@pytest.mark.parametrize("answer, wrong", [
+    ("1,000,000", "1,000,001"),
+    ("3.14159", "3.14158"),
+    ("2024年4月1日", "2024年4月2日"),
+    ("DNAポリメラーゼ", "RNAポリメラーゼ"),
+])
+def test_match_answer_digits_and_ascii_are_exact(answer, wrong):
+    q = attach_answer_norm({"question": "q", "answer": answer})
+    assert match_answer(answer, q)
+    assert not match_answer(wrong, q)
+
+
+def test_match_answer_fuzzy_outside_digits_and_ascii():
+    q = attach_answer_norm({"question": "q", "answer": "DNAポリメラーゼ"})
+    assert match_answer("ＤＮＡポリメラーセ", q)
@@ -0,0 +1,64 @@
+"""重複問題の検出（find_near_duplicate / dedup_new_quiz / dedup_history）のテスト"""
+from quiz_core import (
+    attach_answer_norm,
+    build_quiz_dup_index,
+    dedup_history,
+    dedup_new_quiz,
+    find_near_duplicate,
+    new_dup_index,
+)
+
+
+def q(question, answer, options=None):
+    return attach_answer_norm({"question": question, "answer": answer, "options": options or []})
+
+
+def test_same_question_and_answer_is_duplicate():
+    a = q("ミトコンドリアの主な働きを答えよ。", "ATPの合成")
+    b = q("ミトコンドリアの主な働きを答えよ", "ＡＴＰの合成")
+    assert find_near_duplicate(build_quiz_dup_index([a]), b) == 0
+
+
+def test_different_article_number_is_not_duplicate():
+    a = q("日本国憲法第9条について、その内容を簡潔に説明せよ。", "戦争の放棄")
+    b = q("日本国憲法第19条について、その内容を簡潔に説明せよ。", "戦争の放棄")
+    assert find_near_duplicate(build_quiz_dup_index([a]), b) is None
+
+
+def test_same_stem_with_different_options_is_not_duplicate():
+    a = q("次のうち正しいものを選べ。", "水は100℃で沸騰する", ["水は100℃で沸騰する", "水は50℃で沸騰する"])
+    b = q("次のうち正しいものを選べ。", "光は音より速い", ["光は音より速い", "音は光より速い"])
+    assert find_near_duplicate(build_quiz_dup_index([a]), b) is None
+
+
+def test_same_question_with_different_answer_is_not_duplicate():
+    a = q("細胞内でタンパク質を合成する場所はどこか。", "リボソーム")
+    b = q("細胞内でタンパク質を合成する場所はどこか。", "小胞体")
+    assert find_near_duplicate(build_quiz_dup_index([a]), b) is None
+
+
+def test_option_order_does_not_matter():
+    a = q("次のうち正しいものを選べ。", "A", ["A", "B", "C"])
+    b = q("次のうち正しいものを選べ。", "A", ["C", "A", "B"])
+    assert find_near_duplicate(build_quiz_dup_index([a]), b) == 0
+
+
+def test_dedup_new_quiz_keeps_distinct_choice_questions():
+    quiz = [
+        q("次のうち正しいものを選べ。", "水は100℃で沸騰する", ["水は100℃で沸騰する", "水は50℃で沸騰する"]),
+        q("次のうち正しいものを選べ。", "光は音より速い", ["光は音より速い", "音は光より速い"]),
+        q("次のうち正しいものを選べ。", "光は音より速い", ["光は音より速い", "音は光より速い"]),
+    ]
+    kept, dropped = dedup_new_quiz(quiz, new_dup_index())
+    assert len(kept) == 2 and dropped == 1
+
+
+def test_dedup_history_skips_archived_rows():
+    dup = q("ミトコンドリアの主な働きを答えよ。", "ATPの合成")
+    history = [
+        {"id": "new", "date": "2026/01/02", "updated_at": "t2", "archived": "", "quiz_data": [dict(dup)]},
+        {"id": "old", "date": "2026/01/01", "updated_at": "t1", "archived": True, "quiz_data": [dict(dup)]},
+        {"id": "other", "date": "2026/01/01", "updated_at": "t3", "archived": "", "quiz_data": [dict(dup)]},
+    ]
+    changed, removed = dedup_history(history)
+    assert removed == 1 and set(changed) == {"other"}